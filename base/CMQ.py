@@ -12,12 +12,19 @@ rule-base as one of it's required configuration settings.
 import pymongo
 import serial
 import ast
+import re
 import zmq
 from datetime import datetime
 import json
+import glob
 import time
 import thread
+import threading
+import Queue
 from itertools import cycle
+from collections import deque
+
+_MISSING = object() # no last value of a key
 
 # Useful Functions 
 def pretty_print(task, data):
@@ -30,78 +37,385 @@ def save_config(config, filename):
 
 """
 Rule Class
+A rule writes its command to the target controller when one of its
+conditions, [key, value], becomes true
 """
 class Rule:
-    def __init__(self, conditions, target, command, description=""):
+    def __init__(self, conditions, target, command, description="", safety=False):
         self.conditions = conditions
         self.target = target
         self.command = command
         self.description = description
+        self.safety = safety # written ahead of the other commands
+        self.hits = 0 # commands written
+        self.suppressed = 0 # writes skipped since the value did not change
+
+    # Compile rule dicts from a config into an index of the watched values
+    # Arguments: [ {conditions, target, command, description}, ... ]
+    # Returns: { key : { value : [ Rule, ... ] } }
+    @staticmethod
+    def compile(configs):
+        index = {}
+        for config in configs:
+            try:
+                r = Rule(config['conditions'], config['target'], config['command'], config.get('description', ''), config.get('safety', False))
+            except KeyError as error:
+                pretty_print('CMQ', 'ERROR: Rule does not have a %s' % str(error))
+                continue
+            for [key, val] in r.conditions:
+                index.setdefault(key, {}).setdefault(val, []).append(r)
+        return index
+
+"""
+Frame Parser
+Fast path for the fixed-shape lines which a controller sends, e.g.
+    {'uid':'VDC','data':{'str':12,'act':3,'cart_mode':0,'susp':1},'chksum':118,'task':'push'}
+A regex is compiled once from the key layout of an observed line, and the
+values are converted with the types they had in that line. The checksum is
+the sum of the bytes of the data dict mod 256, as computed by the sketches.
+"""
+class FrameParser:
+
+    FRAME = re.compile(r"^\{'uid':'(\w+)','data':(\{.*\}),'chksum':(\d+),'task':'(\w+)'\}\s*$")
+    KEY = re.compile(r"'(\w+)':")
+
+    def __init__(self, uid, keys, types):
+        self.uid = uid
+        self.keys = keys
+        self.types = types
+        fields = []
+        for (k, t) in zip(keys, types):
+            if t is str:
+                fields.append("'%s':'([^']*)'" % k)
+            else:
+                fields.append("'%s':([^,}]+)" % k)
+        self.regex = re.compile(r"^\{'uid':'%s','data':(\{%s\}),'chksum':(\d+),'task':'(\w+)'\}\s*$" % (re.escape(uid), ','.join(fields)))
+
+    """
+    Compile a parser from a line and its generically parsed event
+    Returns: FrameParser, or None if the line is not a controller frame
+    """
+    @classmethod
+    def learn(cls, line, event):
+        m = cls.FRAME.match(line)
+        if (m is None) or (m.group(1) != event['uid']):
+            return None
+        keys = cls.KEY.findall(m.group(2))
+        if sorted(keys) != sorted(event['data'].keys()):
+            return None # nested or unusual data
+        types = [type(event['data'][k]) for k in keys]
+        return cls(event['uid'], keys, types)
+
+    """
+    Checksum of the raw data bytes
+    Returns: the sum of the bytes mod 256
+    """
+    @staticmethod
+    def checksum(data):
+        return sum(bytearray(data)) % 256
+
+    """
+    Parse a line of the learned layout
+    Returns: (event, passed) where passed is the checksum result, or None on a
+    schema mismatch
+    """
+    def parse(self, line):
+        m = self.regex.match(line)
+        if m is None:
+            return None
+        groups = m.groups()
+        try:
+            data = dict((k, t(v)) for (k, t, v) in zip(self.keys, self.types, groups[1:-2]))
+        except ValueError:
+            return None
+        chksum = int(groups[-2])
+        event = {
+            'uid' : self.uid,
+            'data' : data,
+            'chksum' : chksum,
+            'task' : groups[-1]
+        }
+        return (event, self.checksum(groups[0]) == chksum)
 
 """
 Controller Class
 This is a USB device which is part of a MIMO system
 """
 class Controller:
-    def __init__(self, uid, name, dev_num=None, baud=9600, timeout=1.0, rules=[], port_attempts=3, read_attempts=20, write_timeout=0.5, flushable_chars=256):
-        self.name = name
+    def __init__(self, uid, port, baud=9600, timeout=1.0, rules=[]):
         self.uid = uid # e.g. VDC
         self.baud = baud
         self.timeout = timeout
         self.rules = rules
-        self.uid = uid
+        self.parser = None # FrameParser of the last layout seen
+        self.rule_index = Rule.compile(rules)
+        self.last_values = {} # last value of each watched key
+        self.writer = None # Writer of the outbound commands
+        self.last_seen = time.time() # time of the last line read
         
-        ## Make several attempts to locate serial connection to self.port
-	if not dev_num:
-	        for i in range(port_attempts):
-	            try:
-	                self.name = name + str(i) # e.g. /dev/ttyACM1
-	                pretty_print('CMQ', 'Attempting to attach %s on %s' % (self.uid, self.name))
-	                self.port = serial.Serial(self.name, self.baud, timeout=self.timeout, writeTimeout=write_timeout)
-	                time.sleep(timeout)
-	                while True:
-	      		    while (self.port.inWaiting() > flushable_chars):
-	    			dump = self.port.readline()
-	                    string = self.port.readline()
-	                    if string is not (None or ''):
-	                        try:
-	                            data = ast.literal_eval(string)
-	                            pretty_print('CMQ', 'Read OK, device is %s' % data['uid'])
-	                            if data['uid'] == self.uid:
-	                                pretty_print('CMQ', 'Found matching UID')
-					self.dev_num = i
-	                                return # return the Controller object
-	                            else:
-	                                break
-	                        except Exception as error:
-	                            pretty_print('CMQ', str(error))
-	            except Exception as error:
-	                pretty_print('CMQ', str(error))
-	        else:
-	            raise ValueError('All attempts failed when searching for %s' % self.uid)
-	else:
+        ## The port is found and identified by CMQ.identify
+        self.port = port
+        self.port.timeout = self.timeout
+        self.name = port.port # e.g. /dev/ttyACM1
+
+    # Close the serial port, if one was opened
+    def close(self):
+        try:
+            self.port.close()
+        except Exception as error:
+            pretty_print('CMQ', 'ERROR: Failed to close %s -- %s' % (self.name, str(error)))
+
+"""
+Reader Thread
+Services one controller on its own, so that a slow or silent board never
+holds up the events of the others. Each line is processed (parsed and its
+rules followed) as soon as it arrives and the event is put on the queue of
+the CMQ. The reader stops when the port fails and reports the controller to
+the Supervisor.
+"""
+class Reader(threading.Thread):
+
+    def __init__(self, cmq, dev):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cmq = cmq
+        self.dev = dev
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                line = self.cmq.read(self.dev)
+            except Exception as error:
+                self.cmq.events.put(self.cmq.generate_event('CMQ', 'error', '%s (%s) -- Port Failed: %s' % (self.dev.uid, self.dev.name, str(error))))
+                self.cmq.supervisor.report(self.dev.uid)
+                break
+            if line:
+                self.dev.last_seen = time.time()
+                try:
+                    event = self.cmq.process(self.dev, line)
+                except Exception as error:
+                    event = self.cmq.generate_event('CMQ', 'error', '%s (%s) -- Process Failed: %s' % (self.dev.uid, self.dev.name, str(error)))
+                self.cmq.events.put(event)
+
+    def stop(self):
+        self.running = False
+        self.join(self.dev.timeout * 2) # readline returns within the port timeout
+
+"""
+Writer Thread
+Drains the outbound command queue of one controller, so that reading and
+rule evaluation never wait on the serial buffer of another board. A command
+which is already queued is not queued twice, safety commands are written
+before all others, and when the queue is full the oldest ordinary command is
+dropped. A safety command also drops the ordinary commands queued before it,
+which would otherwise be written after it and undo it. A command which is
+sent again while queued moves to the tail, so the last command sent is always
+the last one written.
+"""
+class Writer(threading.Thread):
+
+    def __init__(self, dev, size=32):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dev = dev
+        self.size = size
+        self.safety = deque() # (t, command, [ on_failure, ... ])
+        self.normal = deque()
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.running = True
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latency = 0.0 # total seconds from queued to written
+        self.max_latency = 0.0
+
+    # Queue a command for the controller, an identical command which is
+    # still queued is moved to the tail instead of being queued twice
+    # Arguments:
+    #     on_failure : called if the command is never written, because the
+    #         write failed, the full queue dropped it or a safety command
+    #         superseded it
+    # Returns: False if an identical command was already queued
+    def send(self, command, safety=False, on_failure=None):
+        with self.condition:
+            entry = (time.time(), command, [])
+            coalesced = command in self.pending
+            if coalesced:
+                # Move the queued copy to the tail, it must not be written
+                # before the commands queued after it
+                for queue in (self.safety, self.normal):
+                    for old in list(queue):
+                        if old[1] == command:
+                            queue.remove(old)
+                            entry = old # latency counts from the first send
+                self.pending.discard(command)
+                self.coalesced += 1
+            if on_failure is not None:
+                entry[2].append(on_failure)
+            if safety:
+                dropped = list(self.normal)
+                self.normal.clear() # superseded by the safety command
+                self.dropped += len(dropped)
+                for old in dropped:
+                    self.pending.discard(old[1])
+                    self.fail(old)
+            elif (len(self.safety) + len(self.normal) >= self.size) and self.normal:
+                old = self.normal.popleft()
+                self.pending.discard(old[1])
+                self.dropped += 1
+                self.fail(old)
+            (self.safety if safety else self.normal).append(entry)
+            self.pending.add(command)
+            self.condition.notify()
+            return not coalesced
+
+    # Run the failure callbacks of a command which was not written
+    def fail(self, entry):
+        for on_failure in entry[2]:
+            try:
+                on_failure()
+            except Exception as error:
+                pretty_print('CMQ', 'ERROR: %s' % str(error))
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                if not (self.safety or self.normal):
+                    self.condition.wait(self.dev.timeout)
+                    continue
+                entry = (self.safety or self.normal).popleft()
+                (t, command, callbacks) = entry
+                self.pending.discard(command)
+            try:
+                self.dev.port.write(command + '\n')
+                latency = time.time() - t
+                self.written += 1
+                self.latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            except Exception as error:
+                self.failed += 1
+                pretty_print('CMQ', 'ERROR: Failed to write %s to %s -- %s' % (command, self.dev.uid, str(error)))
+                self.fail(entry)
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        self.join(self.dev.timeout * 2)
+
+    # Returns: counters of the queue, latencies in ms
+    def stats(self):
+        return {
+            'written' : self.written,
+            'coalesced' : self.coalesced,
+            'dropped' : self.dropped,
+            'failed' : self.failed,
+            'queued' : len(self.safety) + len(self.normal),
+            'write_ms' : round(1000 * self.latency / max(self.written, 1), 2),
+            'max_write_ms' : round(1000 * self.max_latency, 2)
+        }
+
+"""
+Supervisor Thread
+Watches for controllers which drop off the bus, because their port failed or
+went silent, and tears them down. Lost controllers are probed for in the
+background, with a backoff which doubles after every failed attempt, and are
+re-attached by UID when found, while the others keep streaming.
+"""
+class Supervisor(threading.Thread):
+
+    def __init__(self, cmq, silence=5.0, backoff=1.0, max_backoff=30.0, wait=3.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cmq = cmq
+        self.silence = silence # seconds without a line before a port is dead
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.wait = wait # seconds to wait for a UID when probing
+        self.lost = {} # uid : [since, next attempt, backoff]
+        self.reconnects = {}
+        self.downtime = {}
+        self.condition = threading.Condition()
+        self.running = True
+
+    # Report a controller as lost, never blocks
+    def report(self, uid):
+        with self.condition:
+            if uid not in self.lost:
+                now = time.time()
+                self.lost[uid] = [now, now + self.backoff, self.backoff]
+                self.condition.notify()
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait(0.5)
+            now = time.time()
+            for (uid, c) in self.cmq.controllers.items():
+                if now - c.last_seen > self.silence:
+                    pretty_print('CMQ', 'WARNING: %s (%s) is silent' % (uid, c.name))
+                    self.report(uid)
+            with self.condition:
+                lost = dict(self.lost)
             try:
-                self.name = name + str(i) # e.g. /dev/ttyACM1
-                pretty_print('CMQ', 'Attempting to attach %s on %s' % (self.uid, self.name))
-                self.port = serial.Serial(self.name, self.baud, timeout=self.timeout, writeTimeout=write_timeout)
-                time.sleep(2)
-                for j in range(read_attempts):
-                    time.sleep(timeout)
-                    string = self.port.readline()
-                    if string is not (None or ''):
-                        try:
-                            data = ast.literal_eval(string)
-                            pretty_print('CMQ', 'Read OK, device is %s' % data['uid'])
-                            if data['uid'] == self.uid:
-                                pretty_print('CMQ', 'Found matching UID')
-                                return # return the Controller object
-                            else:
-                                break
-                        except Exception as error:
-                            pretty_print('CMQ', str(error))
+                for uid in lost:
+                    if uid in self.cmq.controllers:
+                        pretty_print('CMQ', 'Detaching %s' % uid)
+                        self.cmq.remove_controller(uid)
+                due = [uid for (uid, (since, attempt, backoff)) in lost.items() if now >= attempt]
+                if due:
+                    self.reattach(due)
             except Exception as error:
-                pretty_print('CMQ', str(error))
-		    
+                pretty_print('CMQ', 'ERROR: Supervisor -- %s' % str(error))
+
+    # Probe the free candidate ports for the due controllers
+    def reattach(self, due):
+        configs = dict([(dev['uid'], dev) for dev in self.cmq.config])
+        used = set([c.port.port for c in self.cmq.controllers.values() if hasattr(c, 'port')])
+        names = sorted(set([n for uid in due for n in glob.glob(configs[uid]['name'] + '*')]) - used)
+        found = self.cmq.identify(names, configs[due[0]]['baud'], wait=self.wait)
+        now = time.time()
+        for uid in due:
+            with self.condition:
+                (since, attempt, backoff) = self.lost[uid]
+                if uid in found:
+                    del self.lost[uid]
+                else:
+                    backoff = min(2 * backoff, self.max_backoff)
+                    self.lost[uid] = [since, now + backoff, backoff]
+            if uid in found:
+                self.cmq.add_controller(configs[uid], port=found.pop(uid))
+                self.reconnects[uid] = self.reconnects.get(uid, 0) + 1
+                self.downtime[uid] = self.downtime.get(uid, 0.0) + (now - since)
+                pretty_print('CMQ', 'Re-attached %s after %.1f s' % (uid, now - since))
+            else:
+                pretty_print('CMQ', 'WARNING: %s not found, retrying in %.1f s' % (uid, backoff))
+        for port in found.values():
+            port.close() # attached already, or not part of this network
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        self.join(self.wait * 2)
+
+    # Returns: reconnect count and downtime (s) of a controller, including
+    # the current outage
+    def stats(self, uid):
+        with self.condition:
+            lost = self.lost.get(uid)
+        downtime = self.downtime.get(uid, 0.0)
+        if lost is not None:
+            downtime += time.time() - lost[0]
+        return {
+            'attached' : lost is None,
+            'reconnects' : self.reconnects.get(uid, 0),
+            'downtime' : round(downtime, 1)
+        }
+
 """
 CMQ is a CAN/ZMQ Wondersystem
 
@@ -116,40 +430,124 @@ connection information for the ZMQ host.
 class CMQ:
 
     # Initialize
-    def __init__(self, config, addr="tcp://127.0.0.1:1980", timeout=0.1):
+    def __init__(self, config, addr="tcp://127.0.0.1:1980", timeout=0.1, ports_file='config/CMQ_ports.json'):
         self.addr = addr
+        self.ports_file = ports_file
         self.timeout = timeout
         self.zmq_context = zmq.Context()
-        self.zmq_client = self.zmq_context.socket(zmq.REQ)
-        self.zmq_client.connect(self.addr)
-        self.zmq_poller = zmq.Poller()
-        self.zmq_poller.register(self.zmq_client, zmq.POLLIN)
+        self.connect()
+        self.sent = 0 # batches sent to the OBD
+        self.acked = 0 # responses received
+        self.dropped = 0 # batches the socket could not take
         self.config = config
         self.controllers = {}
+        self.readers = {}
+        self.events = Queue.Queue() # events of all the readers
+        self.supervisor = Supervisor(self)
         try:
+            found = self.discover(config)
             for dev in config:
-                self.add_controller(dev)
+                if dev['uid'] in found:
+                    self.add_controller(dev, found[dev['uid']])
+            save_config(dict([(uid, c.port.port) for (uid, c) in self.controllers.items() if hasattr(c, 'port')]), self.ports_file)
         except Exception as e:
             pretty_print('CMQ', str(e))
+        for dev in config:
+            if dev['uid'] not in self.controllers:
+                pretty_print('CMQ', 'WARNING: %s not found, leaving it to the supervisor' % dev['uid'])
+                self.supervisor.report(dev['uid'])
+        self.supervisor.start()
         pretty_print('CMQ', 'Controller List : %s' % self.list_controllers())
+
+    # Open a set of serial ports at once and read the UID each one reports
+    # Arguments: [ port names ], baud rate, seconds to wait for a UID
+    # Returns: { uid : open serial port }, the other ports are closed
+    def identify(self, names, baud, wait=5.0, write_timeout=0.5):
+        found = {}
+        lock = threading.Lock()
+        def probe(name):
+            try:
+                port = serial.Serial(name, baud, timeout=0.5, writeTimeout=write_timeout)
+            except Exception as error:
+                pretty_print('CMQ', 'Cannot open %s -- %s' % (name, str(error)))
+                return
+            deadline = time.time() + wait # covers the reset of the board on open
+            while time.time() < deadline:
+                try:
+                    m = FrameParser.FRAME.match(port.readline())
+                except Exception as error:
+                    break
+                if m is not None:
+                    uid = m.group(1)
+                    pretty_print('CMQ', 'Found %s on %s' % (uid, name))
+                    with lock:
+                        if uid not in found:
+                            found[uid] = port
+                            return
+                    break # a second board with the same UID
+            port.close()
+        probes = [threading.Thread(target=probe, args=(name,)) for name in names]
+        for t in probes:
+            t.start()
+        for t in probes:
+            t.join()
+        return found
+
+    # Locate the configured controllers, first on the ports they were found on
+    # last time (see ports_file), then on every remaining candidate port
+    # Arguments: the controller configs
+    # Returns: { uid : open serial port }
+    def discover(self, config):
+        uids = [dev['uid'] for dev in config]
+        baud = config[0]['baud'] # the boards share one baud rate
+        try:
+            with open(self.ports_file, 'r') as jsonfile:
+                cached = json.loads(jsonfile.read())
+        except (IOError, ValueError):
+            cached = {}
+        found = self.identify([cached[uid] for uid in uids if uid in cached], baud)
+        missing = [uid for uid in uids if uid not in found]
+        if missing:
+            pretty_print('CMQ', 'Searching for %s' % ', '.join(missing))
+            used = set([port.port for port in found.values()])
+            names = sorted(set([n for dev in config for n in glob.glob(dev['name'] + '*')]) - used)
+            for (uid, port) in self.identify(names, baud).items():
+                if uid in found:
+                    port.close()
+                else:
+                    found[uid] = port
+        for uid in list(found.keys()):
+            if uid not in uids:
+                found.pop(uid).close() # not part of this network
+        return found
         
        
     # Add new controller to the network
     # Checks to make sure UID is correct before inserting into controllers dict
-    def add_controller(self, config, dev_num=None):
+    def add_controller(self, config, port):
         try:
         
             # The device config should have each of these key-vals
             uid = config['uid']
-            name = config['name']
             baud = config['baud']
             timeout = config['timeout']
             rules = config['rules']
             
-            # Attempt to locate controller
-            c = Controller(uid, name, baud=baud, timeout=timeout, rules=rules, dev_num=dev_num)
+            # Attach the controller on its identified port
+            c = Controller(uid, port, baud=baud, timeout=timeout, rules=rules)
             pretty_print('CMQ', "Adding %s on %s" % (c.uid, c.name))
             self.controllers[uid] = c #TODO Save the controller obj if successful
+            c.writer = Writer(c)
+            c.writer.start()
+            self.readers[uid] = Reader(self, c)
+            self.readers[uid].start()
+            
+            # Forget the values that command this controller, so the current
+            # state is sent to it again on the next line of each source
+            for src in self.controllers.values():
+                for (key, rules) in src.rule_index.items():
+                    if any([r.target == uid for val in rules for r in rules[val]]):
+                        src.last_values.pop(key, None)
             
         except Exception as error:
             pretty_print('CMQ', str(error))
@@ -157,23 +555,45 @@ class CMQ:
     # Remove controller from the network by UID
     def remove_controller(self, uid):
         try:
-            port = self.controllers[uid]
-            port.close_all()
-            del self.controllers[uid]
+            reader = self.readers.pop(uid, None)
+            if reader is not None:
+                reader.stop()
+            c = self.controllers.pop(uid)
+            if c.writer is not None:
+                c.writer.stop()
+            c.close()
         except Exception as error:
             pretty_print('CMQ', str(error))
             raise error
 
     # Listen for new event and check rules
     def listen(self, dev):
-    
-        ## Read and parse
         pretty_print('CMQ', '%s (%s) -- Listening' % (dev.uid, dev.name))
         try:
-            while (dev.port.inWaiting() > 128):
-	    	dump = dev.port.readline()
-	    event = ast.literal_eval(dump)
-            if False: # not self.checksum(event):  #! TODO: check sum here?
+            line = self.read(dev)
+        except Exception as e:
+            return self.generate_event('CMQ', 'error', '%s (%s) -- NO DATA' % (dev.uid, dev.name))
+        if not line:
+            return self.generate_event('CMQ', 'error', '%s (%s) -- NO DATA' % (dev.uid, dev.name))
+        return self.process(dev, line)
+
+    # Read the newest line from a controller, dropping any backlog
+    # Arguments: <Controller>
+    # Returns: the line, empty if the port timed out
+    def read(self, dev):
+        while (dev.port.inWaiting() > 128):
+            dev.port.readline()
+        return dev.port.readline()
+
+    # Parse a line from a controller and check rules
+    # Arguments: <Controller>, <str>
+    # Returns: the event, or an 'error' event
+    def process(self, dev, line):
+    
+        ## Parse
+        try:
+            (event, passed) = self.parse(dev, line)
+            if not passed:
                 return self.generate_event('CMQ', 'error', '%s (%s) -- Checksum Failed' % (dev.uid, dev.name))
             pretty_print('CMQ', '%s (%s) -- OKAY' % (dev.uid, dev.name))
         except SyntaxError as e:
@@ -182,55 +602,61 @@ class CMQ:
         except Exception as e:
             return self.generate_event('CMQ', 'error', '%s (%s) -- NO DATA' % (dev.uid, dev.name))
             
-        ## Follow rule-base
+        ## Follow rule-base, only for the fields which changed
         data = event['data']
-        for r in dev.rules:
-            try:
-                target = r['target']
-            except Exception as e:
-		pretty_print('CMQ', 'ERROR: %s' % 'Rule does not have a target')
-            	pass
-            try:
-                cmd = r['command']
-            except Exception as e:
-		pretty_print('CMQ', 'ERROR: %s' % 'Rule does not have a command')
-		pass
-            try:
-                desc = r['description']
-            except Exception as e:
-                pretty_print('CMQ', 'ERROR: %s' % 'Rule does not have description')
-		pass
-            try:
-                target_dev = self.controllers[target]
-            except Exception as e:
-		pretty_print('CMQ', 'ERROR: %s does not exist!' % target)
-		pass
-            for [key,val] in r['conditions']:
-                if (data[key] == val): # TODO: might have to handle Unicode
-                    try:
-                        # target_dev.port.flushOutput()
-                        pretty_print('CMQ', 'Writing %s command to %s ...' % (str(cmd), str(target)))
-                        target_dev.port.write(str(cmd) + '\n')
-                    except Exception as e:
-                        pretty_print('CMQ', 'ERROR: Failed to follow rule -- %s' % desc)
+        for (key, rules) in dev.rule_index.iteritems():
+            if key not in data:
+                continue
+            val = data[key]
+            if dev.last_values.get(key, _MISSING) == val: # a writer may forget the key meanwhile
+                for r in rules.get(val, []):
+                    r.suppressed += 1 # the command was already sent for this value
+                continue
+            # The value only stays handled if every command is queued on an
+            # attached target, a failed write forgets it again
+            dev.last_values[key] = val
+            for r in rules.get(val, []):
+                try:
+                    target_dev = self.controllers[r.target]
+                    pretty_print('CMQ', 'Queueing %s command to %s ...' % (str(r.command), str(r.target)))
+                    target_dev.writer.send(str(r.command), safety=r.safety, on_failure=lambda key=key: dev.last_values.pop(key, None)) # never blocks
+                    r.hits += 1
+                except Exception as e:
+                    dev.last_values.pop(key, None)
+                    pretty_print('CMQ', 'ERROR: Failed to follow rule -- %s' % r.description)
         return event
         
-    # Listen for data from all arduino controllers
+    # Collect the events of all arduino controllers, as queued by their readers
+    # Waits up to the timeout for the first event, then takes all queued ones
     # Arguments: None
     # Returns: List of each successfully parsed event
     def listen_all(self):
-	if self.controllers:
+        if self.controllers:
             events = []
-            for c in self.controllers.values(): # get name of each controller in network
-                try:
-                    e = self.listen(c) # listen for event
-                    events.append(e)
-                except Exception as error:
-                    events.append(self.generate_event("CMQ", 'error', str(error))) # create 'error' event
+            try:
+                events.append(self.events.get(timeout=self.timeout))
+                while True:
+                    events.append(self.events.get_nowait())
+            except Queue.Empty:
+                pass
             return events
         else:
             return [self.generate_event("CMQ", 'error', 'Empty Network!')]
     
+    # Counters of each controller
+    # Returns: { uid : { counter : value } }
+    def stats(self):
+        stats = dict([(dev['uid'], self.supervisor.stats(dev['uid'])) for dev in self.config])
+        for (uid, c) in self.controllers.items():
+            rules = set([r for by_val in c.rule_index.values() for by_rule in by_val.values() for r in by_rule])
+            stats.setdefault(uid, {}).update({
+                'rule_hits' : sum([r.hits for r in rules]),
+                'rule_suppressed' : sum([r.suppressed for r in rules])
+            })
+            if c.writer is not None:
+                stats[uid].update(c.writer.stats())
+        return stats
+
     # List all arduino controllers in the network
     def list_controllers(self):
         return self.controllers.keys()
@@ -246,61 +672,91 @@ class CMQ:
         }
         return event
     
-    # Compares the Check sum of an event from a controller to the proper value
-    # Arguments: <Event>
+    # Parse a line from a controller, with the fast parser of its layout if
+    # the line matches it, otherwise generically, learning the new layout
+    # Arguments: <Controller>, <str>
+    # Returns: (event, passed) where passed is the checksum result
+    def parse(self, dev, line):
+        if dev.parser is not None:
+            result = dev.parser.parse(line)
+            if result is not None:
+                return result
+        event = ast.literal_eval(line)
+        dev.parser = FrameParser.learn(line, event)
+        return (event, self.checksum(line))
+
+    # Compares the Check sum of a line from a controller to the proper value
+    # Arguments: <str>
     # Returns: True if it passes the checksum, False if otherwise
-    def checksum(self, event):
-        try:
-            chksum = 0
-            data = str(event['data'])
-            data = "".join(data.split()) # remove whitespace
-            for c in data:
-                chksum += ord(c)
-            if (chksum % 256) == event['chksum']:
-                return True
-            else:
-                return False
-        except Exception as e:
-            pretty_print('CMQ', 'ERROR: %s' % str(e))
+    def checksum(self, line):
+        m = FrameParser.FRAME.match(line)
+        if m is None:
+            return False
+        return FrameParser.checksum(m.group(2)) == int(m.group(3))
         
+    # Connect to the OBD with a DEALER socket, so that batches are sent
+    # without waiting for the response to the previous one; the empty
+    # delimiter frame lets the REP socket of the OBD route the responses
+    def connect(self, hwm=100):
+        self.zmq_client = self.zmq_context.socket(zmq.DEALER)
+        self.zmq_client.setsockopt(zmq.LINGER, 0)
+        try:
+            self.zmq_client.setsockopt(zmq.SNDHWM, hwm)
+        except AttributeError:
+            self.zmq_client.setsockopt(zmq.HWM, hwm) # ZMQ 2.x
+        self.zmq_client.connect(self.addr)
+        self.zmq_poller = zmq.Poller()
+        self.zmq_poller.register(self.zmq_client, zmq.POLLIN)
+
+    # Send the events of one pass to the OBD as a single batch, never blocks
+    def send_batch(self, events):
+        batch = self.generate_event('CMQ', 'batch', events)
+        try:
+            self.zmq_client.send_multipart(['', json.dumps(batch)], zmq.NOBLOCK)
+            self.sent += 1
+        except zmq.ZMQError as error:
+            self.dropped += 1 # the OBD is not keeping up
+            pretty_print('CMQ', 'WARNING: Dropped batch of %d events -- %s' % (len(events), str(error)))
+
+    # Read every response which has arrived, never blocks
+    def receive_all(self):
+        while dict(self.zmq_poller.poll(0)).get(self.zmq_client) == zmq.POLLIN:
+            response = json.loads(self.zmq_client.recv_multipart(zmq.NOBLOCK)[-1])
+            self.acked += 1
+            #! TODO handle any fancy push/pull responses from the host
+            """
+            CURRENTLY THIS SECTION DOES NOTHING
+            IN THE FUTURE, THE OBD WILL BE ABLE TO ROUTE TESTING
+            AND OTHER DIAGNOSTIC COMMANDS TO THE CMQ
+            """
+
     # Run Indefinitely
-    def run_async(self, frequency=10):
+    # Each pass waits for the events queued by the readers (see listen_all)
+    # and sends them as one batch, at most `frequency` batches per second
+    def run_async(self, frequency=10, stats_period=10.0):
+        stats_time = time.time()
         while True:
-	    a = time.time()
-            events = self.listen_all()
-            for e in events: # Read newest 
-                try:
-                    dump = json.dumps(e)
-                    self.zmq_client.send(dump)
-                    time.sleep(self.timeout)
-                    socks = dict(self.zmq_poller.poll(self.timeout))
-                    if socks:
-                        if socks.get(self.zmq_client) == zmq.POLLIN:
-                            dump = self.zmq_client.recv(zmq.NOBLOCK) # zmq.NOBLOCK
-                            response = json.loads(dump)
-                            pretty_print('CMQ', 'Received response from OBD')
-                            #! TODO handle any fancy push/pull responses from the host
-                            """
-                            CURRENTLY THIS SECTION DOES NOTHING
-                            IN THE FUTURE, THE OBD WILL BE ABLE TO ROUTE TESTING
-                            AND OTHER DIAGNOSTIC COMMANDS TO THE CMQ
-                            """
-                        else:
-                            pretty_print('CMQ', 'WARNING: Poller Timeout')
-                    else:
-                        pretty_print('CMQ', 'WARNING: Socket Timeout')
-                except Exception as error:
-                    pretty_print('CMQ', 'ERROR: %s' % str(error))
-            b = time.time()
-            while (1 / (float(b - a)) > frequency):
-		time.sleep(0.01)
-		b = time.time()
+            a = time.time()
+            if a - stats_time > stats_period:
+                stats = self.stats()
+                stats['OBD'] = {'sent' : self.sent, 'acked' : self.acked, 'dropped' : self.dropped}
+                pretty_print('CMQ', 'Stats: %s' % json.dumps(stats))
+                stats_time = a
+            try:
+                events = self.listen_all()
+                if events:
+                    self.send_batch(events)
+                self.receive_all()
+            except Exception as error:
+                pretty_print('CMQ', 'ERROR: %s' % str(error))
+            time.sleep(max(1.0 / frequency - (time.time() - a), 0))
+
     # Reset server socket connection
     def reset(self):
         pretty_print('CMQ','Resetting CMQ connection to OBD')
         try:
-            self.zmq_client = self.zmq_context.socket(zmq.REQ)
-            self.zmq_client.connect(self.addr)
+            self.zmq_client.close()
+            self.connect()
         except Exception:
             pretty_print('CMQ', 'ERROR: Failed to reset properly')
 
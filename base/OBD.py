@@ -18,8 +18,55 @@ import os
 from datetime import datetime
 import thread
 import json
+import time
+import numpy as np
 
 # Classes
+"""
+Speed Filter
+Kalman filter of the ground speed v and the wheel slip s (km/hr), such that
+the axle speed (wheel or driveshaft) measures v + s and V6 measures v alone.
+The controllers update it at their own rate and the slower vision estimates
+correct the slip, so the fused speed does not drift when the wheels slip.
+"""
+class SpeedFilter:
+
+    def __init__(self, q_speed=4.0, q_slip=0.05, r_wheel=0.25, r_vision=1.0):
+        self.q = np.array([q_speed, q_slip]) # process noise per second
+        self.r_wheel = r_wheel
+        self.r_vision = r_vision
+        self.x = np.zeros(2) # [v, s]
+        self.P = np.diag([100.0, 1.0]) # slip starts near zero
+        self.t = None
+
+    def predict(self, t):
+        if self.t is not None:
+            self.P = self.P + np.diag(self.q * max(t - self.t, 0.0))
+        self.t = t
+
+    def correct(self, z, H, r, t):
+        if not np.isfinite(z):
+            return False # e.g. V6 sends NaN when it has no speeds, it would poison the state
+        self.predict(t)
+        H = np.array(H, dtype=np.float64)
+        S = H.dot(self.P).dot(H) + r
+        K = self.P.dot(H) / S
+        self.x = self.x + K * (z - H.dot(self.x))
+        self.P = self.P - np.outer(K, H.dot(self.P))
+        return True
+
+    ## Axle speed, from the wheel and/or driveshaft
+    def wheel(self, v, t):
+        return self.correct(v, [1.0, 1.0], self.r_wheel, t)
+
+    ## Vision speed
+    def vision(self, v, t):
+        return self.correct(v, [1.0, 0.0], self.r_vision, t)
+
+    ## Returns: (speed, one-sigma uncertainty) in km/hr
+    def estimate(self):
+        return (self.x[0], np.sqrt(self.P[0, 0]))
+
 class WatchDog:
 
     # Useful Functions 
@@ -35,6 +82,7 @@ class WatchDog:
 	    'ESC' : 'INACTIVE',
 	    'TCS' : 'INACTIVE'
 	}
+        self.init_fusion()
         self.init_cmq()
         self.init_db()
         self.init_logging()
@@ -54,6 +102,45 @@ class WatchDog:
         except Exception as error:
             self.pretty_print('OBD_ERR', 'ERROR: %s' % str(error))
         
+    ## Initialize Speed Fusion
+    def init_fusion(self):
+        self.speed_filter = SpeedFilter(
+            q_speed=self.config['FUSION_Q_SPEED'],
+            q_slip=self.config['FUSION_Q_SLIP'],
+            r_wheel=self.config['FUSION_R_WHEEL'],
+            r_vision=self.config['FUSION_R_VISION']
+        )
+
+    ## Fuse a controller or V6 push into the ground speed estimate
+    # Returns: the fused data which was added to self.data
+    def fuse_speed(self, uid, data):
+        t = time.time()
+        try:
+            if uid == 'CV6':
+                self.speed_filter.vision(float(data['v_avg']), t)
+            elif uid == 'TCS':
+                # The wheel and the driveshaft measure the same axle speed, so
+                # they are fused as one measurement, their mean
+                k = np.pi * self.config['WHEEL_DIAMETER'] * 0.06 # rpm to km/hr
+                speeds = []
+                if 'wheel_rpm' in data:
+                    speeds.append(k * float(data['wheel_rpm']))
+                if 'driveshaft_rpm' in data:
+                    diff_ratio = float(data.get('diff_ratio', 0)) or self.config['DIFF_RATIO']
+                    speeds.append(k * float(data['driveshaft_rpm']) / diff_ratio)
+                speeds = [v for v in speeds if np.isfinite(v)]
+                if speeds:
+                    self.speed_filter.wheel(np.mean(speeds), t)
+        except (KeyError, ValueError, ZeroDivisionError) as error:
+            self.pretty_print('OBD', 'ERROR: Cannot fuse speed -- %s' % str(error))
+        (v, sigma) = self.speed_filter.estimate()
+        fused = {
+            'v_fused' : round(v, 2),
+            'v_conf' : round(sigma, 2) # one-sigma, km/hr
+        }
+        self.data.update(fused)
+        return fused
+
     ## Initialize DB
     def init_db(self):
         try:
@@ -105,13 +192,36 @@ class WatchDog:
             
     ## Listen for Messages
     #! TODO Include setting warnings for the debugger page
+    # Requests come from REQ clients or from DEALER clients (CMQ, V6) which
+    # send an empty delimiter frame; a CMQ batch is answered in one response
     def listen(self):
         try:
             # Receive message from CAN
             packet = self.socket.recv()
+        except Exception as error:
+            self.pretty_print('OBD', 'ERROR: %s' % str(error))
+            return
+        try:
             event = json.loads(packet)
             self.pretty_print('OBD', 'Received: %s' % str(event))
-            
+            if (event['uid'] == 'CMQ') and (event['task'] == 'batch'):
+                response = self.generate_event('OBD', 'batch_resp', [self.handle(e) for e in event['data']])
+            else:
+                response = self.handle(event)
+        except Exception as error:
+            self.pretty_print('OBD', 'ERROR: %s' % str(error))
+            response = self.generate_event('OBD', 'error_resp', str(error))
+        try:
+            dump = json.dumps(response)
+            self.socket.send(dump) # send response, the REP socket expects one for every request
+            self.pretty_print('OBD', 'Response: %s' % str(response))
+        except Exception as error:
+            self.pretty_print('OBD', 'ERROR: %s' % str(error))
+
+    ## Handle a single event
+    # Returns: the response event
+    def handle(self, event):
+        try:
             # Save to Database
             self.add_log_entry(event)
             
@@ -168,7 +278,8 @@ class WatchDog:
                 elif event['task'] == 'push':
 		    self.data['TCS'] = 'OK'
                     self.data.update(event['data'])  # Set incoming data to the global "data" object
-                    response = self.generate_event('OBD', 'push_resp', {})
+                    fused = self.fuse_speed(uid, event['data'])
+                    response = self.generate_event('OBD', 'push_resp', fused)
                 else:
                     raise ValueError('Unrecognized task for TCS')
             elif uid == 'CV6':
@@ -176,16 +287,16 @@ class WatchDog:
                     response = self.generate_event('OBD', 'error_resp', {})
                 elif event['task'] == 'push':
                     self.data.update(event['data'])  # Set incoming data to the global "data" object
+                    self.fuse_speed(uid, event['data'])
                     response = self.generate_event('OBD', 'push_resp', {})
                 else:
                     raise ValueError('Unrecognized task for CV6 request')
             else:
                 raise ValueError('Unknown UID!')
-            dump = json.dumps(response)
-            self.socket.send(dump) # send response
-            self.pretty_print('OBD', 'Response: %s' % str(response))
         except Exception as error:
             self.pretty_print('OBD', 'ERROR: %s' % str(error))
+            response = self.generate_event('OBD', 'error_resp', str(error))
+        return response
     
     """
     Handler Functions
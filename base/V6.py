@@ -14,16 +14,487 @@ import cv2, cv
 import numpy as np
 import time
 import sys
+import os
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from itertools import cycle
+from collections import deque
 import zmq
 import json
 from datetime import datetime
+try:
+    import gps as gpsd
+except ImportError:
+    gpsd = None # only needed to log GPS fixes
 
 # Useful Functions 
 def pretty_print(task, msg):
     date = datetime.strftime(datetime.now(), '[%d/%b/%Y:%H:%M:%S]')
     print("%s %s %s" % (date, task, msg))
+
+# Speed estimators, see V6.set_engine
+ENGINES = ['FEATURES', 'PHASE', 'FLOW', 'RIGID']
+
+# Keypoint backends, the binary ones are matched by Hamming distance
+BACKENDS = ['SURF', 'ORB', 'FAST']
+BINARY_BACKENDS = ['ORB', 'FAST']
+
+# Fixed-width record of the binary session log, see SessionLog
+LOG_PERCENTILES = [5, 25, 50, 75, 95]
+LOG_RECORD = np.dtype([
+    ('t', '<f8'), # epoch seconds, time.time()
+    ('v', '<f4', (len(LOG_PERCENTILES),)), # km/hr at each of LOG_PERCENTILES
+    ('matches', '<i4'),
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+    ('alt', '<f8'),
+])
+
+def clock():
+    return cv2.getTickCount() / cv2.getTickFrequency() # monotonic seconds
+
+"""
+Load a binary session log without copying
+Returns: memory-mapped array of LOG_RECORD
+"""
+def load_log(path):
+    log = np.memmap(path, dtype=LOG_RECORD, mode='r')
+    unused = np.flatnonzero(log['t'] == 0) # preallocated tail if the log was not closed
+    if len(unused):
+        log = log[:unused[0]]
+    return log
+
+"""
+Session Log
+Appends LOG_RECORD entries to a preallocated, memory-mapped binary file which
+grows by `chunk` records at a time and is trimmed to its length on close
+"""
+class SessionLog:
+
+    def __init__(self, path, chunk=4096):
+        self.path = path
+        self.chunk = chunk
+        self.count = 0
+        self.file = open(path, 'w+b')
+        self.records = None
+        self.grow()
+
+    def grow(self):
+        capacity = self.chunk if (self.records is None) else len(self.records) + self.chunk
+        if self.records is not None:
+            self.records.flush()
+        self.file.truncate(capacity * LOG_RECORD.itemsize)
+        self.records = np.memmap(self.file, dtype=LOG_RECORD, mode='r+', shape=(capacity,))
+
+    def append(self, t, v_best, matches, fix):
+        if self.count == len(self.records):
+            self.grow()
+        if len(v_best):
+            v = np.percentile(v_best, LOG_PERCENTILES)
+        else:
+            v = [np.nan] * len(LOG_PERCENTILES)
+        (lat, lon, alt) = fix
+        self.records[self.count] = (t, v, matches, lat, lon, alt)
+        self.count += 1
+
+    def close(self):
+        self.records.flush()
+        self.records = None
+        self.file.truncate(self.count * LOG_RECORD.itemsize)
+        self.file.close()
+
+"""
+GPS Reader Thread
+Follows gpsd on its own thread so waiting on a fix never stalls estimation
+"""
+class GPSReader(threading.Thread):
+
+    def __init__(self, retry=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if gpsd is None:
+            raise Exception("No gpsd client installed")
+        self.connect()
+        self.retry = retry
+        self.fix = (np.nan, np.nan, np.nan)
+        self.lock = threading.Lock()
+        self.running = True
+
+    def connect(self):
+        self.session = gpsd.gps()
+        self.session.stream()
+
+    """
+    Follow the fixes of gpsd, reconnecting every `retry` seconds while it is
+    gone, with no fix in the meantime rather than the last one
+    """
+    def run(self):
+        while self.running:
+            try:
+                self.session.next()
+                fix = self.session.fix
+                with self.lock:
+                    self.fix = (fix.latitude, fix.longitude, fix.altitude)
+            except Exception as e:
+                pretty_print('GPS', 'WARNING: gpsd lost -- %s' % str(e))
+                with self.lock:
+                    self.fix = (np.nan, np.nan, np.nan)
+                time.sleep(self.retry)
+                try:
+                    self.connect()
+                except Exception as e:
+                    pretty_print('GPS', 'WARNING: Failed to reconnect to gpsd -- %s' % str(e))
+
+    """
+    Returns: the latest (lat, lon, alt)
+    """
+    def latest(self):
+        with self.lock:
+            return self.fix
+
+    def stop(self):
+        self.running = False
+
+"""
+Capture Thread
+Keeps draining a cv2.VideoCapture into a ring buffer of (t, bgr) entries,
+t is taken from the monotonic clock as soon as the frame has been grabbed
+"""
+class Capture(threading.Thread):
+
+    def __init__(self, camera, size=4, timeout=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.camera = camera
+        self.timeout = timeout
+        self.frames = deque(maxlen=size)
+        self.count = 0 # total number of frames captured
+        self.condition = threading.Condition()
+        self.running = True
+        
+    def run(self):
+        while self.running:
+            if not self.camera.grab():
+                time.sleep(0.01)
+                continue
+            t = clock()
+            (s, bgr) = self.camera.retrieve()
+            if s:
+                with self.condition:
+                    self.frames.append((t, bgr))
+                    self.count += 1
+                    self.condition.notify_all()
     
+    """
+    Return the newest n entries, waiting until a frame newer than the
+    frame count `after` exists
+    Returns: (count, [ (t, bgr), ... ])
+    """
+    def latest(self, n=2, after=0):
+        deadline = clock() + self.timeout
+        with self.condition:
+            while (self.count <= after) or (len(self.frames) < n):
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    raise Exception('Capture timed out!')
+                self.condition.wait(remaining)
+            return (self.count, list(self.frames)[-n:])
+    
+    def stop(self):
+        self.running = False
+        self.join(self.timeout)
+
+"""
+Publisher Thread
+Sends events to the OBD off the vision thread. Only the latest event is held,
+an event which is replaced before it could be sent is dropped as stale.
+A DEALER socket is used so that a missed reply never leaves the socket stuck
+the way a REQ socket gets stuck; replies are read whenever they arrive.
+"""
+class Publisher(threading.Thread):
+
+    def __init__(self, addr, timeout=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.addr = addr
+        self.timeout = timeout
+        self.event = None
+        self.sent = 0
+        self.dropped = 0
+        self.received = 0
+        self.condition = threading.Condition()
+        self.running = True
+
+    """
+    Replace the pending event with a newer one, never blocks
+    """
+    def publish(self, event):
+        with self.condition:
+            if self.event is not None:
+                self.dropped += 1
+            self.event = event
+            self.condition.notify()
+
+    def run(self):
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        try:
+            socket.setsockopt(zmq.SNDHWM, 1)
+        except AttributeError:
+            socket.setsockopt(zmq.HWM, 1) # ZMQ 2.x
+        socket.connect(self.addr)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        while self.running:
+            with self.condition:
+                if self.event is None:
+                    self.condition.wait(self.timeout)
+                (event, self.event) = (self.event, None)
+            if event is not None:
+                try:
+                    socket.send_multipart(['', json.dumps(event)], zmq.NOBLOCK) # empty delimiter for the REP host
+                    self.sent += 1
+                except zmq.ZMQError as err:
+                    self.dropped += 1 # the host is not keeping up
+            try:
+                while dict(poller.poll(0)).get(socket) == zmq.POLLIN:
+                    response = json.loads(socket.recv_multipart(zmq.NOBLOCK)[-1])
+                    self.received += 1
+                    pretty_print('CV6', 'Received: %s' % str(response))
+            except Exception as err:
+                pretty_print('CV6', str(err))
+        socket.close()
+
+    def stop(self):
+        self.running = False
+        self.join(self.timeout * 2)
+
+"""
+Display Thread
+Debug view of the matches, drawn off the vision thread into a canvas which is
+allocated from the first frame, and again only if the frame size changes, as
+cameras may not honour the requested resolution. Only the latest result is
+kept, at most max_matches of its pairs are drawn, and the window refreshes at
+a fixed rate however fast the estimates arrive. Pressing any key closes the
+view.
+"""
+class Display(threading.Thread):
+
+    def __init__(self, w, h, rate=10.0, max_matches=50, name='V6'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.w = w
+        self.h = h
+        self.period = 1.0 / rate
+        self.max_matches = max_matches
+        self.window = name
+        self.canvas = None # allocated from the first frame
+        self.result = None
+        self.lock = threading.Lock()
+        self.running = True
+        self.closed = False
+
+    """
+    Replace the result on display, never blocks
+    """
+    def show(self, pairs, bgr1, bgr2):
+        with self.lock:
+            self.result = (pairs, bgr1, bgr2)
+
+    def draw(self, pairs, bgr1, bgr2):
+        (self.h, self.w) = bgr1.shape[:2]
+        if (self.canvas is None) or (self.canvas.shape[:2] != (self.h, 2 * self.w)):
+            self.canvas = np.zeros((self.h, 2 * self.w, 3), np.uint8)
+        for (frame, x) in ((bgr1, 0), (bgr2, self.w)):
+            if frame.ndim == 2:
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            if frame.shape[:2] != (self.h, self.w):
+                frame = cv2.resize(frame, (self.w, self.h))
+            self.canvas[:, x:x + self.w] = frame
+        pairs = np.asarray(pairs, dtype=np.float32).reshape(-1, 2, 2)
+        if len(pairs) > self.max_matches:
+            pairs = pairs[np.linspace(0, len(pairs) - 1, self.max_matches).astype(np.intp)]
+        pairs = np.int32(pairs + np.float32([[0, 0], [self.w, 0]])) # second point on the right frame
+        cv2.polylines(self.canvas, list(pairs), False, (255,0,0), 1)
+        for ((x1, y1), (x2, y2)) in pairs:
+            cv2.circle(self.canvas, (x1, y1), 5, (0,0,255), 2)
+            cv2.circle(self.canvas, (x2, y2), 5, (0,255,0), 2)
+
+    def run(self):
+        while self.running:
+            t = clock()
+            with self.lock:
+                (result, self.result) = (self.result, None)
+            if result is not None:
+                self.draw(*result)
+                cv2.imshow(self.window, self.canvas)
+            if cv2.waitKey(1) != -1:
+                self.closed = True
+                break
+            time.sleep(max(self.period - (clock() - t), 0))
+        cv2.destroyWindow(self.window)
+
+    def stop(self):
+        self.running = False
+        self.join(self.period * 2)
+
+"""
+Feature Cache
+Frames and their detected features, in a compressed NumPy archive (.npz)
+The frames are kept in recorded order as (t, hash) and the features are keyed
+by (frame hash, detector key), so one recording serves many detector settings
+With a path of None, the cache is only held in memory
+"""
+class FeatureCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.order = [] # [ (t, hash), ... ]
+        self.frames = {} # hash : gray
+        self.entries = {} # (hash, detector key) : (pts, desc)
+        if (path is not None) and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def frame_hash(gray):
+        return hashlib.sha1(np.ascontiguousarray(gray)).hexdigest()
+
+    def add_frame(self, t, gray):
+        h = self.frame_hash(gray)
+        self.order.append((t, h))
+        self.frames[h] = gray
+        return h
+
+    def lookup(self, h, key):
+        return self.entries.get((h, key))
+
+    def store(self, h, key, features):
+        self.entries[(h, key)] = features
+
+    def save(self):
+        hashes = [h for (t, h) in self.order]
+        arrays = {
+            'times' : np.array([t for (t, h) in self.order], dtype=np.float64),
+            'hashes' : np.array(hashes),
+            'frames' : np.array([self.frames[h] for h in hashes]),
+        }
+        keys = sorted(set([k for (h, k) in self.entries]))
+        for (j, key) in enumerate(keys):
+            found = [h for h in hashes if (h, key) in self.entries]
+            features = [self.entries[(h, key)] for h in found]
+            descs = [desc for (pts, desc) in features if (desc is not None) and len(desc)]
+            arrays['detector_%d' % j] = np.array(key)
+            arrays['hashes_%d' % j] = np.array(found)
+            arrays['offsets_%d' % j] = np.cumsum([0] + [len(pts) for (pts, desc) in features])
+            arrays['pts_%d' % j] = np.concatenate([pts for (pts, desc) in features]).reshape(-1, 2)
+            arrays['desc_%d' % j] = np.concatenate(descs) if descs else np.zeros((0, 0), np.float32)
+        arrays['detectors'] = np.array(len(keys))
+        with open(self.path, 'wb') as npzfile:
+            np.savez_compressed(npzfile, **arrays)
+
+    def load(self):
+        archive = np.load(self.path)
+        for (t, h, gray) in zip(archive['times'], archive['hashes'], archive['frames']):
+            self.order.append((float(t), str(h)))
+            self.frames[str(h)] = gray
+        for j in range(int(archive['detectors'])):
+            key = str(archive['detector_%d' % j])
+            offsets = archive['offsets_%d' % j]
+            (pts, desc) = (archive['pts_%d' % j], archive['desc_%d' % j])
+            for (i, h) in enumerate(archive['hashes_%d' % j]):
+                (a, b) = (offsets[i], offsets[i + 1])
+                self.entries[(str(h), key)] = (pts[a:b], desc[a:b] if b > a else None)
+
+"""
+Quality Controller
+Holds V6 to a target estimate rate by stepping through a ladder of quality
+levels, from level 0 (full quality) to levels - 1 (cheapest). Each level sets a
+stricter detector threshold and a smaller processing scale, interpolated
+between the configured bounds. The latency of each estimate is smoothed and
+the level moves by one whenever the smoothed latency leaves the band around
+the deadline 1 / rate, once the current level has had `settle` estimates.
+Required arguments:
+    rate : target estimates/sec
+Optional arguments:
+    levels : number of quality levels
+    hessian, features, threshold : (best, cheapest) detector settings of the
+        SURF, ORB and FAST backends, see start()
+    scale : (best, cheapest) processing scale of the frames
+    band : fraction of the deadline the smoothed latency may drift by
+    smoothing : weight of the newest latency
+    settle : estimates at a level before the level may move again
+"""
+class QualityController:
+
+    def __init__(self, rate, levels=5, hessian=(500, 4000), features=(500, 150), threshold=(20, 60), scale=(1.0, 0.5), band=0.15, smoothing=0.3, settle=5):
+        if rate <= 0:
+            raise Exception("Cannot have a target rate of zero")
+        if levels < 1:
+            raise Exception("Cannot have less than one quality level")
+        self.deadline = 1.0 / rate
+        self.levels = levels
+        self.hessian = hessian
+        self.features = features
+        self.threshold = threshold
+        self.scale = scale
+        self.band = band
+        self.smoothing = smoothing
+        self.settle = settle
+        self.level = 0
+        self.latency = None
+        self.samples = 0 # estimates at the current level
+
+    """
+    Start level 0 from the detector settings in use, e.g. tuned ones, instead
+    of the configured best bounds. The cheapest bounds are kept at least as
+    cheap as level 0.
+    """
+    def start(self, hessian, features, threshold):
+        self.hessian = (hessian, max(hessian, self.hessian[1]))
+        self.features = (features, min(features, self.features[1]))
+        self.threshold = (threshold, max(threshold, self.threshold[1]))
+        self.level = 0
+        self.latency = None
+        self.samples = 0
+
+    """
+    Settings of a quality level, the hessian is stepped geometrically
+    Returns: dict of hessian, features, threshold and scale
+    """
+    def settings(self, level):
+        k = level / float(max(self.levels - 1, 1))
+        return {
+            'hessian' : self.hessian[0] * (self.hessian[1] / float(self.hessian[0]))**k,
+            'features' : int(round(self.features[0] + k * (self.features[1] - self.features[0]))),
+            'threshold' : int(round(self.threshold[0] + k * (self.threshold[1] - self.threshold[0]))),
+            'scale' : self.scale[0] + k * (self.scale[1] - self.scale[0]),
+        }
+
+    """
+    Update with the latency of the last estimate (seconds)
+    Returns: True if the level changed
+    """
+    def update(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        self.samples += 1
+        if self.samples < self.settle:
+            return False
+        if (self.latency > self.deadline * (1 + self.band)) and (self.level < self.levels - 1):
+            self.level += 1
+        elif (self.latency < self.deadline * (1 - self.band)) and (self.level > 0):
+            self.level -= 1
+        else:
+            return False
+        self.latency = None # settle on the new level before moving again
+        self.samples = 0
+        return True
+
 class V6:
 
     """
@@ -37,8 +508,14 @@ class V6:
         yaw : 
         hessian : iterations of hessian filter
         frame
+        streaming : reuse the features of the previous frame for each estimate
+        threaded : read the camera from a background capture thread
+        backend : keypoint backend, one of BACKENDS
+        use_flann : match with FLANN instead of brute force
+        engine : speed estimator, one of ENGINES
+    Set capture to None to only run the estimators on given frames
     """
-    def __init__(self, capture=0, fov=0.75, f=6, aspect=1.33, d=241, roll=0, pitch=0, yaw=0, hessian=1000, w=640, h=480, neighbors=2, factor=0.7):
+    def __init__(self, capture=0, fov=0.75, f=6, aspect=1.33, d=241, roll=0, pitch=0, yaw=0, hessian=1000, w=640, h=480, neighbors=2, factor=0.7, streaming=False, threaded=False, backend='SURF', use_flann=False, engine='FEATURES', features=500, threshold=20):
         
         # Things which should be set once
         try:
@@ -46,7 +523,16 @@ class V6:
                 capture = int(capture)
         except Exception as e:
             pass
-        self.camera = cv2.VideoCapture(capture)
+        if capture is not None:
+            self.camera = cv2.VideoCapture(capture)
+        else:
+            self.camera = None # frames are passed to the estimators directly
+        self.capture = None
+        self.grabbed = 0 # frame count of the newest frame used
+        self.publisher = None
+        self.scale = 1.0 # processing scale of the detector
+        self.quality = None
+        self.waited = 0.0 # seconds spent waiting for frames
        
         # Things which can be changed at any time
         self.set_matchfactor(factor)
@@ -59,33 +545,243 @@ class V6:
         self.set_yaw(yaw) # 0 rad
         self.set_depth(d) # camera distance at center
         self.set_neighbors(neighbors)
-        self.set_matcher(hessian)
+        self.set_matcher(hessian, use_flann=use_flann, backend=backend, features=features, threshold=threshold)
+        self.set_streaming(streaming)
+        self.set_tracker()
+        self.set_ransac()
+        self.set_guidance()
+        self.set_engine(engine)
+        if threaded:
+            self.start_capture()
         
     """
     Set the keypoint matcher configuration, supports BF or FLANN
+    Backends:
+        SURF : float descriptors, hessian is the detector threshold
+        ORB : binary descriptors, keeps the best `features` keypoints
+        FAST : FAST corners (with `threshold`) and binary BRIEF descriptors
     """
-    def set_matcher(self, hessian, use_flann=False):
+    def set_matcher(self, hessian, use_flann=False, backend='SURF', features=500, threshold=20):
         try:
-            self.surf = cv2.SURF(hessian)
+            if backend == 'SURF':
+                self.detector = cv2.SURF(hessian)
+                self.extractor = None
+            elif backend == 'ORB':
+                self.detector = cv2.ORB(features)
+                self.extractor = None
+            elif backend == 'FAST':
+                self.detector = cv2.FastFeatureDetector(threshold)
+                self.extractor = cv2.DescriptorExtractor_create('BRIEF')
+            else:
+                raise Exception("Unknown backend %s" % backend)
+            binary = backend in BINARY_BACKENDS
             # Use the FLANN matcher
             if use_flann:
-                self.FLANN_INDEX_KDTREE = 1
-                self.FLANN_TREES = 5
+                if binary:
+                    self.FLANN_INDEX_LSH = 6
+                    self.INDEX_PARAMS = dict(algorithm=self.FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+                else:
+                    self.FLANN_INDEX_KDTREE = 1
+                    self.FLANN_TREES = 5
+                    self.INDEX_PARAMS = dict(algorithm=self.FLANN_INDEX_KDTREE, trees=self.FLANN_TREES)
                 self.FLANN_CHECKS = 50
-                self.INDEX_PARAMS = dict(algorithm=self.FLANN_INDEX_KDTREE, trees=self.FLANN_TREES)
                 self.SEARCH_PARAMS = dict(checks=self.FLANN_CHECKS) # or pass empty dictionary
                 self.matcher = cv2.FlannBasedMatcher(self.INDEX_PARAMS, self.SEARCH_PARAMS)
             # Use the Brute Force matcher
+            elif binary:
+                self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
             else:
                 self.matcher = cv2.BFMatcher()
+            self.backend = backend
+            self.hessian = hessian
+            self.features = features
+            self.threshold = threshold
+            self.use_flann = use_flann
         except Exception as e:
             print str(e)
             raise Exception("Failed to generate a matcher")
     """
+    Detector Key
+    Returns: a string which identifies the keypoints and descriptors produced
+    """
+    def detector_key(self):
+        if self.backend == 'SURF':
+            key = 'SURF-%g' % self.hessian
+        elif self.backend == 'ORB':
+            key = 'ORB-%d' % self.features
+        else:
+            key = 'FAST-%d-BRIEF' % self.threshold
+        if self.max_keypoints:
+            key += '+top%dx%d' % (self.max_keypoints, self.bucket_grid)
+        if self.scale != 1.0:
+            key += '@%g' % self.scale
+        return key
+
+    """
+    Set Streaming
+    When streaming, the keypoints and descriptors of the last frame are kept
+    so that each estimate only runs the detector on the newest frame
+    """
+    def set_streaming(self, streaming):
+        self.streaming = streaming
+        self.previous = None # (t, bgr, prepared) of the last frame
+
+    """
+    Set Engine
+    Select the speed estimator used by run() and run_async()
+    engine : one of ENGINES
+    rectify : correlate a top-down view of the ground (PHASE only)
+    """
+    def set_engine(self, engine, rectify=False):
+        if engine == 'FEATURES':
+            self.estimator = self.estimate_vector
+        elif engine == 'PHASE':
+            self.estimator = self.estimate_phase
+        elif engine == 'FLOW':
+            self.estimator = self.estimate_flow
+        elif engine == 'RIGID':
+            self.estimator = self.estimate_rigid
+        else:
+            raise Exception("Unknown engine %s" % engine)
+        self.engine = engine
+        self.rectify = rectify
+        self.rectifier = None
+        self.window = None
+        self.tracks = None
+        self.motion = None
+        self.prior = None
+        self.previous = None # prepared frames differ between engines
+
+    """
+    Set RANSAC
+    Configure the rigid motion fit of the RIGID engine
+        iterations : number of two-point hypotheses
+        tolerance : inlier distance [px]
+    """
+    def set_ransac(self, iterations=64, tolerance=2.0):
+        if iterations < 1:
+            raise Exception("Cannot have less than one hypothesis")
+        self.ransac_iterations = iterations
+        self.ransac_tolerance = tolerance
+
+    """
+    Set Guidance
+    Bound the cost of matching the FEATURES and RIGID engines
+        max_keypoints : keep at most this many keypoints, the strongest of each
+            cell of a grid x grid bucketing so they spread over the frame (0 for all)
+        grid : cells per side of the bucketing
+        window : half-size of the search window of guided matching [px] (0 for
+            brute force), a window around where each keypoint is predicted to
+            land from the image motion of the last estimate
+        min_matches : fall back to brute force below this many guided matches
+    """
+    def set_guidance(self, max_keypoints=0, grid=4, window=0, min_matches=8):
+        if grid < 1:
+            raise Exception("Cannot have less than one grid cell")
+        self.max_keypoints = max_keypoints
+        self.bucket_grid = grid
+        self.guide_window = window
+        self.guide_min_matches = min_matches
+        self.prior = None # image motion of the last estimate [px/s]
+
+    """
+    Set Quality
+    Attach a QualityController, or None to detect at the full resolution with
+    the matcher settings as they are. Level 0 of the controller starts from the
+    current matcher settings, and the settings of its level are applied at once.
+    """
+    def set_quality(self, quality):
+        self.quality = quality
+        if quality is None:
+            self.scale = 1.0
+        else:
+            quality.start(self.hessian, self.features, self.threshold)
+            self.apply_quality()
+
+    def apply_quality(self):
+        q = self.quality.settings(self.quality.level)
+        self.set_matcher(q['hessian'], use_flann=self.use_flann, backend=self.backend, features=q['features'], threshold=q['threshold'])
+        self.scale = q['scale']
+
+    """
+    Settings
+    Returns: the keyword arguments which rebuild this V6 with the same setup
+    """
+    def settings(self):
+        return {
+            'fov' : self.fov,
+            'f' : self.f,
+            'aspect' : self.aspect,
+            'd' : self.d,
+            'roll' : self.roll,
+            'pitch' : self.pitch,
+            'yaw' : self.yaw,
+            'hessian' : self.hessian,
+            'features' : self.features,
+            'threshold' : self.threshold,
+            'w' : self.w,
+            'h' : self.h,
+            'neighbors' : self.neighbors,
+            'factor' : self.factor,
+            'backend' : self.backend,
+            'use_flann' : self.use_flann,
+            'engine' : self.engine,
+        }
+
+    """
+    Guidance
+    Returns: the keyword arguments of set_guidance for this setup
+    """
+    def guidance(self):
+        return {
+            'max_keypoints' : self.max_keypoints,
+            'grid' : self.bucket_grid,
+            'window' : self.guide_window,
+            'min_matches' : self.guide_min_matches,
+        }
+
+    """
+    Set Tracker
+    Configure the pyramidal Lucas-Kanade tracker of the FLOW engine
+        max_tracks : corners detected when (re)detecting
+        min_tracks : redetect when fewer tracks survive
+        min_coverage : redetect when the tracks cover less of the grid
+        grid : cells per side of the coverage grid
+        win : search window size [px]
+        levels : pyramid levels
+    """
+    def set_tracker(self, max_tracks=200, min_tracks=50, min_coverage=0.25, grid=4, win=21, levels=3):
+        if min_tracks > max_tracks:
+            raise Exception("Cannot keep more tracks than are detected")
+        self.max_tracks = max_tracks
+        self.min_tracks = min_tracks
+        self.min_coverage = min_coverage
+        self.grid = grid
+        self.LK_PARAMS = dict(winSize=(win, win), maxLevel=levels, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.tracks = None
+
+    """
+    Start Capture
+    Read the camera from a background thread into a ring buffer of `size`
+    frames, so that estimates never block on the camera
+    """
+    def start_capture(self, size=4):
+        if self.capture is None:
+            self.capture = Capture(self.camera, size=size)
+            self.capture.start()
+
+    """
     Close
     """  
     def close(self):
-        self.camera.release()
+        if self.publisher is not None:
+            self.publisher.stop()
+            self.publisher = None
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
+        if self.camera is not None:
+            self.camera.release()
         
     def set_matchfactor(self, factor):
         if factor < 0:
@@ -113,8 +809,10 @@ class V6:
         else:
             self.w = w
             self.h = h
-            self.camera.set(cv.CV_CAP_PROP_FRAME_WIDTH, w)
-            self.camera.set(cv.CV_CAP_PROP_FRAME_HEIGHT, h)
+            self.table = None # projection depends on the frame size
+            if self.camera is not None:
+                self.camera.set(cv.CV_CAP_PROP_FRAME_WIDTH, w)
+                self.camera.set(cv.CV_CAP_PROP_FRAME_HEIGHT, h)
     
     """
     Set distance at center of frame
@@ -125,6 +823,7 @@ class V6:
             raise Exception("Improper distance")
         else:
             self.d = d
+            self.table = None
 
     """
     Set Pitch
@@ -138,6 +837,7 @@ class V6:
             raise Exception("Cannot have inclination parallel to surface")
         else:
             self.pitch = pitch
+            self.table = None
 
     """
     Set Roll
@@ -166,6 +866,7 @@ class V6:
             raise Exception("Cannot have FOV greater than Pi radians")
         else:
             self.fov = fov
+            self.table = None
 
     """
     Set Aspect Ratio
@@ -192,39 +893,197 @@ class V6:
     To get the most recent images, flush the buffer of older frames
     """
     def flush(self, frames=2):
+        if self.capture is not None:
+            return # the capture thread always holds the newest frames
         for i in range(frames):
             (s, bgr) = self.camera.read()
+
+    """
+    Read Frames
+    Get n consecutive frames, from the capture thread if one is running
+    Returns: [ (t, bgr), ... ]
+    """
+    def read_frames(self, n=2):
+        t = clock()
+        try:
+            return self.grab_frames(n)
+        finally:
+            self.waited += clock() - t # time blocked on the camera, see run_async
+
+    def grab_frames(self, n):
+        if self.capture is not None:
+            (self.grabbed, entries) = self.capture.latest(n, after=self.grabbed)
+        else:
+            entries = []
+            for i in range(n):
+                (s, bgr) = self.camera.read()
+                entries.append((clock(), bgr))
+        return entries
             
+    """
+    Detect Features
+    Find the keypoints and descriptors of a single image (bgr or grayscale)
+    Returns: (points, descriptors) where points is an Nx2 array of (x, y)
+    """
+    def detect_features(self, image):
+        if image is None:
+            raise Exception('No image to detect!')
+        if image.ndim == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image
+        if self.scale != 1.0:
+            gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if (self.extractor is None) and not self.max_keypoints:
+            (kp, desc) = self.detector.detectAndCompute(gray, None)
+        else:
+            kp = self.detector.detect(gray, None)
+            if self.max_keypoints:
+                kp = self.bucket_keypoints(kp, gray.shape) # only describe the kept keypoints
+            (kp, desc) = (self.extractor or self.detector).compute(gray, kp)
+        pts = np.array([k.pt for k in kp], dtype=np.float32).reshape(-1, 2)
+        if self.scale != 1.0:
+            pts /= self.scale # back to full resolution pixels
+        return (pts, desc)
+
+    """
+    Bucket Keypoints
+    Keep the max_keypoints strongest keypoints, at most an equal share of them
+    from each cell of the bucketing grid
+    Returns: [ keypoint, ... ]
+    """
+    def bucket_keypoints(self, kp, shape):
+        if len(kp) <= self.max_keypoints:
+            return kp
+        g = self.bucket_grid
+        (h, w) = shape[:2]
+        xy = np.array([k.pt for k in kp], dtype=np.float32)
+        response = np.array([k.response for k in kp], dtype=np.float32)
+        cell = np.minimum(np.int32(xy[:, 1] * g / h), g - 1) * g + np.minimum(np.int32(xy[:, 0] * g / w), g - 1)
+        order = np.lexsort((-response, cell)) # by cell, strongest first
+        cell = cell[order]
+        first = np.searchsorted(cell, cell) # index of the first keypoint of each cell
+        rank = np.arange(len(cell)) - first
+        keep = order[rank < max(self.max_keypoints // (g * g), 1)]
+        return [kp[i] for i in keep]
+
+    """
+    KNN Match
+    Find the nearest neighbors in desc2 of each descriptor in desc1
+    Returns: [ [m, n, ...], ... ] as given by the matcher
+    """
+    def knn_match(self, desc1, desc2):
+        if (self.matcher is not None):
+            if (desc1 is None) or (desc2 is None) or (len(desc1) == 0) or (len(desc2) == 0):
+                return []
+            return self.matcher.knnMatch(desc1, desc2, k=self.neighbors)
+        else:
+            raise Exception("No matcher exists!")
+
+    """
+    Ratio Test
+    Keep the matches which are clearly better than their second neighbor
+    Returns: (pts1, pts2) as Nx2 arrays of matching points
+    """
+    def ratio_test(self, all_matches, pts1, pts2):
+        knn = np.array([(k[0].queryIdx, k[0].trainIdx, k[0].distance, k[1].distance) for k in all_matches if len(k) >= 2], dtype=np.float64).reshape(-1, 4)
+        good = knn[:, 2] < self.factor * knn[:, 3]
+        idx = knn[good, :2].astype(np.intp)
+        return (pts1[idx[:, 0]].reshape(-1, 2), pts2[idx[:, 1]].reshape(-1, 2))
+
+    """
+    Guided Match
+    Match each keypoint of frame 1 only against the keypoints of frame 2 inside
+    the search window around its predicted position, so descriptor distances
+    are computed for the candidate pairs alone. The keypoints of frame 2 are
+    sorted by x, so the window test only visits the strip around each
+    prediction rather than all N x M pairs. The ratio test is then applied
+    among the candidates of each keypoint; a keypoint with a single candidate
+    is kept.
+    Arguments:
+        shift : (dx, dy) predicted image motion [px]
+    Returns: (pts1, pts2) as Nx2 arrays of matching points
+    """
+    def guided_match(self, features1, features2, shift):
+        (pts1, desc1) = features1
+        (pts2, desc2) = features2
+        if (desc1 is None) or (desc2 is None) or (len(desc1) == 0) or (len(desc2) == 0):
+            return (np.zeros((0, 2), np.float32), np.zeros((0, 2), np.float32))
+        predicted = pts1 + np.float32(shift)
+        by_x = np.argsort(pts2[:, 0], kind='mergesort')
+        xs = pts2[by_x, 0]
+        lo = np.searchsorted(xs, predicted[:, 0] - self.guide_window, side='right')
+        hi = np.searchsorted(xs, predicted[:, 0] + self.guide_window, side='left')
+        counts = np.maximum(hi - lo, 0)
+        i = np.repeat(np.arange(len(pts1)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) # position in the strip
+        j = by_x[np.repeat(lo, counts) + k]
+        near = np.abs(predicted[i, 1] - pts2[j, 1]) < self.guide_window
+        (i, j) = (i[near], j[near])
+        if len(i) == 0:
+            return (np.zeros((0, 2), np.float32), np.zeros((0, 2), np.float32))
+        if self.backend in BINARY_BACKENDS:
+            d = np.unpackbits(np.bitwise_xor(desc1[i], desc2[j]), axis=1).sum(axis=1).astype(np.float64) # Hamming
+        else:
+            d = np.sqrt(np.sum((desc1[i].astype(np.float64) - desc2[j])**2, axis=1)) # L2
+        order = np.lexsort((d, i)) # by keypoint, nearest first
+        (i, j, d) = (i[order], j[order], d[order])
+        first = np.flatnonzero(np.r_[True, i[1:] != i[:-1]])
+        second = first + 1
+        has_second = np.zeros(len(first), dtype=bool)
+        has_second[second < len(i)] = i[second[second < len(i)]] == i[first[second < len(i)]]
+        good = np.ones(len(first), dtype=bool)
+        good[has_second] = d[first[has_second]] < self.factor * d[second[has_second]]
+        best = first[good]
+        return (pts1[i[best]].reshape(-1, 2), pts2[j[best]].reshape(-1, 2))
+
+    """
+    Match Pairs
+    Guided matching when a prior image motion is known (see set_guidance),
+    otherwise brute force knnMatch and the ratio test. The image motion of the
+    resulting pairs becomes the prior of the next call.
+    Returns: (pts1, pts2) as Nx2 arrays of matching points
+    """
+    def match_pairs(self, features1, features2, dt):
+        (pts1, desc1) = features1
+        (pts2, desc2) = features2
+        good = None
+        if self.guide_window and (self.prior is not None):
+            good = self.guided_match(features1, features2, self.prior * dt)
+            if len(good[0]) < self.guide_min_matches:
+                good = None # the motion changed too much, search everywhere
+        if good is None:
+            good = self.ratio_test(self.knn_match(desc1, desc2), pts1, pts2)
+        if len(good[0]) >= self.guide_min_matches:
+            self.prior = np.median(good[1] - good[0], axis=0) / dt
+        else:
+            self.prior = None
+        return good
+
+    """
+    Match Features
+    Find (good) pairs of matching points between two sets of detected features
+    Returns: [ (pt1, pt2), ... ]
+    """
+    def match_features(self, features1, features2):
+        (pts1, desc1) = features1
+        (pts2, desc2) = features2
+        all_matches = self.knn_match(desc1, desc2)
+        (good1, good2) = self.ratio_test(all_matches, pts1, pts2)
+        return [(tuple(pt1), tuple(pt2)) for (pt1, pt2) in zip(good1.tolist(), good2.tolist())]
+
     """
     Match Images
     Find (good) pairs of matching points between two images
     Returns: [ (pt1, pt2), ... ]
     """
     def match_images(self, bgr1, bgr2):
-        if (self.matcher is not None):
-            if (bgr1 is not None) and (bgr2 is not None):
-                gray1 = cv2.cvtColor(bgr1, cv2.COLOR_BGR2GRAY)
-                gray2 = cv2.cvtColor(bgr2, cv2.COLOR_BGR2GRAY)
-                (pts1, desc1) = self.surf.detectAndCompute(gray1, None)
-                (pts2, desc2) = self.surf.detectAndCompute(gray2, None)
-                matching_pairs = []
-                if pts1 and pts2:
-                    all_matches = self.matcher.knnMatch(desc1, desc2, k=self.neighbors)
-                    try:
-                        for (m,n) in all_matches:
-                            if m.distance < self.factor * n.distance:
-                                pt1 = pts1[m.queryIdx]
-                                pt2 = pts2[m.trainIdx]
-                                pt1 = (pt1.pt[0], pt1.pt[1])
-                                pt2 = (pt2.pt[0], pt2.pt[1])
-                                matching_pairs.append((pt1, pt2))
-                    except Exception as e:
-                        print str(e)
-                return matching_pairs
-            else:
-                raise Exception('No images to match!')
+        if (bgr1 is not None) and (bgr2 is not None):
+            features1 = self.detect_features(bgr1)
+            features2 = self.detect_features(bgr2)
+            return self.match_features(features1, features2)
         else:
-            raise Exception("No matcher exists!")
+            raise Exception('No images to match!')
     
     """
     Distance between two keypoints, where keypoints are in units of pixels
@@ -271,116 +1130,519 @@ class V6:
             X = x * np.sqrt( (self.d**2 + Y**2) / (l**2 + y**2) )
         return (X, Y)
     
+    """
+    Projection Table
+    Tabulate the ground-plane projection of every pixel row as (rows, Y, scale)
+    such that project(x, y) = (x * scale[y], Y[y]). The table only depends on
+    the camera setup, so it is rebuilt when fov, w, h, d or pitch change
+    """
+    def projection_table(self):
+        if self.table is None:
+            rows = np.arange(self.h + 1, dtype=np.float64)
+            f = 2.0 * np.tan(self.fov / 2.0)
+            l = self.w / f
+            theta = np.arctan(rows / l)
+            Y = self.d / np.tan( (np.pi / 2.0 - self.pitch) - theta)
+            scale = np.sqrt( (self.d**2 + Y**2) / (l**2 + rows**2) )
+            self.table = (rows, Y, scale)
+        return self.table
+
+    """
+    Project many points from pixels to real units with the projection table
+    Required arguments:
+        points : Nx2 array of (x, y)
+    Returns:
+        Nx2 array of (X, Y)
+    """
+    def project_many(self, points):
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        (rows, Y, scale) = self.projection_table()
+        x = pts[:, 0]
+        y = pts[:, 1]
+        return np.column_stack((x * np.interp(y, rows, scale), np.interp(y, rows, Y)))
+
+    """
+    Distances between two arrays of keypoints
+    Arguments:
+        pts1 : Nx2 array of (x1, y1)
+        pts2 : Nx2 array of (x2, y2)
+    Returns:
+        distances : array of N floats
+    """
+    def distances(self, pts1, pts2, project=False):
+        if project:
+            pts1 = self.project_many(pts1)
+            pts2 = self.project_many(pts2)
+        diff = np.asarray(pts2, dtype=np.float64) - np.asarray(pts1, dtype=np.float64)
+        return np.sqrt(np.sum(diff**2, axis=1))
+
+    """
+    Convert distances travelled over dt to speeds (km/hr) and drop the
+    outliers outside of the p_min and p_max percentiles
+    """
+    def filter_speeds(self, dists, dt, p_min=5, p_max=95):
+        v_all = (3.6 / 1000.0) * (np.asarray(dists) / dt) # convert from m/s to km/hr
+        v_min = np.percentile(v_all, p_min)
+        v_max = np.percentile(v_all, p_max)
+        v_top = v_all[v_all > v_min]
+        v_best = v_top[v_top < v_max]
+        return v_best
+
+    """
+    Read Pair
+    Get two frames and prepare each of them for an estimator engine
+    In streaming mode, the first frame is the prepared frame of the previous
+    estimate so each frame is only prepared once
+    Required arguments:
+        prepare : function of a bgr frame (e.g. detect_features)
+    Optional arguments:
+        frames : [ (t1, bgr1), (t2, bgr2) ] to use instead of reading the camera
+        dt : the time between each frame, if fixed
+    Without a fixed dt, streaming from a camera starts the capture thread, as
+    frames read in place are timed after the previous estimate
+    Returns:
+        ((t1, bgr1, prepared1), (t2, bgr2, prepared2))
+    """
+    def read_pair(self, prepare, frames=None, dt=None):
+        if frames is not None:
+            [(t1, bgr1), (t2, bgr2)] = frames
+            prepared1 = prepare(bgr1)
+            prepared2 = prepare(bgr2)
+        elif self.streaming:
+            if (dt is None) and (self.capture is None) and (self.camera is not None):
+                self.start_capture()
+                self.previous = None
+            # Slide the pair forward, only the newest frame is prepared
+            if self.previous is None:
+                [(t1, bgr1)] = self.read_frames(1)
+                self.previous = (t1, bgr1, prepare(bgr1))
+            (t1, bgr1, prepared1) = self.previous
+            [(t2, bgr2)] = self.read_frames(1)
+            try:
+                prepared2 = prepare(bgr2)
+            except Exception as e:
+                self.previous = None # the pair is broken, start over
+                raise e
+            self.previous = (t2, bgr2, prepared2)
+        else:
+            # Flush buffer
+            self.flush(3)
+            [(t1, bgr1), (t2, bgr2)] = self.read_frames(2)
+            if (bgr1 is None) or (bgr2 is None):
+                raise Exception('No images to match!')
+            prepared1 = prepare(bgr1)
+            prepared2 = prepare(bgr2)
+        return ((t1, bgr1, prepared1), (t2, bgr2, prepared2))
+
     """
     Optional:
         dt : time differential between bgr1 and bgr2
+        frames : frame pair to use instead of reading the camera, see read_pair
+    In streaming mode, bgr1 is the frame of the previous estimate
     Returns:
         v : the estimated speed of travel
         t : the estimated angle moved between two keypoints
-        pairs : matching pairs between bgr1 and bgr2
+        pairs : Nx2x2 array of the matching pairs between bgr1 and bgr2
         bgr1 : the first image
         bgr2 : the second image
         
     """
-    def estimate_vector(self, dt=None, p_min=5, p_max=95):
-        # Flush buffer
-        for i in range(3):
-            self.camera.read()
-        # Read first
-        (s1, bgr1) = self.camera.read()
-        t1 = time.time()
-        # Read second
-        (s2, bgr2) = self.camera.read()
-        t2 = time.time()
+    def estimate_vector(self, dt=None, p_min=5, p_max=95, frames=None):
+        ((t1, bgr1, features1), (t2, bgr2, features2)) = self.read_pair(self.detect_features, frames=frames, dt=dt)
         # If no dt specificed:
         if not dt:
             dt = t2 - t1
-        # Match keypoint pairss
-        pairs = self.match_images(bgr1, bgr2)
-        # Convert units
-        dists = [self.distance(pt1, pt2, project=True) for (pt1, pt2) in pairs]
-        dists = np.array(dists)
-        v_all = (3.6 / 1000.0) * (dists / dt) # convert from m/s to km/hr
-        v_min = np.percentile(v_all, p_min)
-        v_max = np.percentile(v_all, p_max)
-        v_top = v_all[v_all > v_min]
-        v_best = v_top[v_top < v_max]
+        (v_best, pairs) = self.match_vector(features1, features2, dt, p_min=p_min, p_max=p_max)
         return (v_best, pairs, bgr1, bgr2) # (gamma, theta)
+
+    """
+    Matching and projection stages of estimate_vector on detected features
+    Returns: (v_best, pairs)
+    """
+    def match_vector(self, features1, features2, dt, p_min=5, p_max=95):
+        # Match keypoint pairs
+        (good1, good2) = self.match_pairs(features1, features2, dt)
+        # Convert units
+        dists = self.distances(good1, good2, project=True)
+        v_best = self.filter_speeds(dists, dt, p_min=p_min, p_max=p_max)
+        pairs = np.concatenate((good1[:, None], good2[:, None]), axis=1)
+        return (v_best, pairs)
+
+    """
+    Fit Motion
+    Fit a rigid ground-plane motion (rotation theta, translation t) which takes
+    ground1 onto ground2, with RANSAC over two-point hypotheses followed by a
+    least-squares refit on the inliers. All hypotheses are scored at once.
+    Arguments:
+        ground1 : Nx2 array of projected points in the first frame
+        ground2 : Nx2 array of the same points in the second frame
+    Returns:
+        (theta, t, inliers) where t is (tx, ty) and inliers a boolean mask
+    """
+    def fit_motion(self, ground1, ground2):
+        n = len(ground1)
+        if n < 2:
+            raise Exception('Too few matches to fit a motion!')
+        (rows, Y, scale) = self.projection_table()
+        tolerance = self.ransac_tolerance * np.median(scale) # px to ground units
+        # Hypotheses from random pairs of matches
+        idx = np.random.randint(0, n, (self.ransac_iterations, 2))
+        idx = idx[idx[:, 0] != idx[:, 1]]
+        if len(idx) == 0:
+            idx = np.array([[0, 1]])
+        (a1, b1) = (ground1[idx[:, 0]], ground1[idx[:, 1]])
+        (a2, b2) = (ground2[idx[:, 0]], ground2[idx[:, 1]])
+        theta = np.arctan2(b2[:, 1] - a2[:, 1], b2[:, 0] - a2[:, 0]) - np.arctan2(b1[:, 1] - a1[:, 1], b1[:, 0] - a1[:, 0])
+        (c, s) = (np.cos(theta), np.sin(theta))
+        tx = a2[:, 0] - (c * a1[:, 0] - s * a1[:, 1])
+        ty = a2[:, 1] - (s * a1[:, 0] + c * a1[:, 1])
+        # Score every hypothesis against every match (K x N)
+        (x1, y1) = (ground1[:, 0], ground1[:, 1])
+        ex = c[:, None] * x1 - s[:, None] * y1 + tx[:, None] - ground2[:, 0]
+        ey = s[:, None] * x1 + c[:, None] * y1 + ty[:, None] - ground2[:, 1]
+        inliers = (ex**2 + ey**2) < tolerance**2
+        inliers = inliers[np.argmax(inliers.sum(axis=1))]
+        if inliers.sum() < 2:
+            raise Exception('No consistent motion found!')
+        # Refit on the inliers
+        (g1, g2) = (ground1[inliers], ground2[inliers])
+        (m1, m2) = (g1.mean(axis=0), g2.mean(axis=0))
+        (q1, q2) = (g1 - m1, g2 - m2)
+        theta = np.arctan2(np.sum(q1[:, 0] * q2[:, 1] - q1[:, 1] * q2[:, 0]), np.sum(q1[:, 0] * q2[:, 0] + q1[:, 1] * q2[:, 1]))
+        (c, s) = (np.cos(theta), np.sin(theta))
+        t = m2 - np.array([c * m1[0] - s * m1[1], s * m1[0] + c * m1[1]])
+        return (theta, t, inliers)
+
+    """
+    Estimate the speed and heading from a single rigid motion fit of all the
+    matches, see fit_motion()
+    The motion is taken at the ground point under the center of the frame, and
+    (v, heading, omega) is kept in self.motion (km/hr, rad, rad/s)
+    Optional:
+        dt : time differential between bgr1 and bgr2
+    Returns:
+        (v_best, pairs, bgr1, bgr2), same as estimate_vector, where v_best holds
+        the single estimate and pairs the inlier matches
+    """
+    def estimate_rigid(self, dt=None, p_min=5, p_max=95, frames=None):
+        ((t1, bgr1, features1), (t2, bgr2, features2)) = self.read_pair(self.detect_features, frames=frames, dt=dt)
+        if not dt:
+            dt = t2 - t1
+        (v_best, pairs) = self.match_rigid(features1, features2, dt)
+        return (v_best, pairs, bgr1, bgr2)
+
+    """
+    Matching and motion fit stages of estimate_rigid on detected features
+    Returns: (v_best, pairs)
+    """
+    def match_rigid(self, features1, features2, dt, p_min=5, p_max=95):
+        (good1, good2) = self.match_pairs(features1, features2, dt)
+        (theta, t, inliers) = self.fit_motion(self.project_many(good1), self.project_many(good2))
+        center = self.project_many([(self.w / 2.0, self.h / 2.0)])[0]
+        (c, s) = (np.cos(theta), np.sin(theta))
+        shift = np.array([c * center[0] - s * center[1], s * center[0] + c * center[1]]) + t - center
+        v = (3.6 / 1000.0) * (np.sqrt(np.sum(shift**2)) / dt) # convert from m/s to km/hr
+        self.motion = (v, np.arctan2(shift[1], shift[0]), theta / dt)
+        pairs = np.concatenate((good1[inliers, None], good2[inliers, None]), axis=1)
+        return (np.array([v]), pairs)
+
+    """
+    Rectification Maps
+    Remap tables from a top-down view of the ground plane to the camera image,
+    built from the projection table so they follow the same camera setup
+    Returns:
+        (mapx, mapy, res) where res is the ground distance of one output pixel
+    """
+    def rectification_maps(self):
+        table = self.projection_table()
+        if (self.rectifier is None) or (self.rectifier[0] is not table):
+            (rows, Y, scale) = table
+            res = max((Y[-1] - Y[0]) / self.h, scale.max()) # fit the whole view
+            (u, v) = np.meshgrid(np.arange(self.w), np.arange(self.h))
+            mapy = np.interp(Y[0] + v * res, Y, rows) # Y increases with the row
+            mapx = (u * res) / np.interp(mapy, rows, scale)
+            self.rectifier = (table, mapx.astype(np.float32), mapy.astype(np.float32), res)
+        return self.rectifier[1:]
+
+    """
+    Prepare a frame for phase correlation
+    Returns: float32 grayscale image, rectified to the ground plane if enabled
+    """
+    def prepare_phase(self, bgr):
+        if bgr is None:
+            raise Exception('No image to correlate!')
+        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        if self.rectify:
+            (mapx, mapy, res) = self.rectification_maps()
+            gray = cv2.remap(gray, mapx, mapy, cv2.INTER_LINEAR)
+        return np.float32(gray)
+
+    """
+    Estimate the speed with windowed FFT phase correlation of the whole frame
+    The cost does not depend on the ground texture, only on the frame size
+    Optional:
+        dt : time differential between bgr1 and bgr2
+    Returns:
+        (v_best, pairs, bgr1, bgr2), same as estimate_vector, where v_best holds
+        the single estimate and pairs the displacement of the frame center
+    """
+    def estimate_phase(self, dt=None, p_min=5, p_max=95, frames=None):
+        ((t1, bgr1, gray1), (t2, bgr2, gray2)) = self.read_pair(self.prepare_phase, frames=frames, dt=dt)
+        if not dt:
+            dt = t2 - t1
+        (h, w) = gray1.shape
+        if (self.window is None) or (self.window.shape != gray1.shape):
+            self.window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+        shift = cv2.phaseCorrelate(gray1, gray2, self.window)
+        if isinstance(shift[0], tuple):
+            shift = shift[0] # newer OpenCV also returns the response
+        (dx, dy) = shift
+        (cx, cy) = (w / 2.0, h / 2.0)
+        pairs = [((cx, cy), (cx + dx, cy + dy))]
+        if self.rectify:
+            (mapx, mapy, res) = self.rectification_maps()
+            dist = np.sqrt(dx**2 + dy**2) * res
+        else:
+            dist = self.distances([pairs[0][0]], [pairs[0][1]], project=True)[0]
+        v_best = np.array([(3.6 / 1000.0) * (dist / dt)]) # convert from m/s to km/hr
+        return (v_best, pairs, bgr1, bgr2)
+
+    """
+    Prepare a frame for tracking
+    Returns: grayscale image
+    """
+    def prepare_flow(self, bgr):
+        if bgr is None:
+            raise Exception('No image to track!')
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+
+    """
+    Check if the tracks are too few or bunched into one area of the frame
+    """
+    def needs_redetect(self, pts):
+        if len(pts) < self.min_tracks:
+            return True
+        cells = np.int32(pts.reshape(-1, 2) * self.grid / np.float32([self.w, self.h]))
+        cells = np.clip(cells, 0, self.grid - 1)
+        occupied = len(np.unique(cells[:, 1] * self.grid + cells[:, 0]))
+        return occupied < self.min_coverage * self.grid**2
+
+    """
+    Estimate the speed by tracking points across frames with sparse pyramidal
+    optical flow, the corners are only redetected when needs_redetect()
+    Tracks are only carried over between estimates in streaming mode
+    Optional:
+        dt : time differential between bgr1 and bgr2
+    Returns:
+        (v_best, pairs, bgr1, bgr2), same as estimate_vector
+    """
+    def estimate_flow(self, dt=None, p_min=5, p_max=95, frames=None):
+        ((t1, bgr1, gray1), (t2, bgr2, gray2)) = self.read_pair(self.prepare_flow, frames=frames, dt=dt)
+        if not dt:
+            dt = t2 - t1
+        # Reuse the tracks only if they ended on the first frame
+        if (self.tracks is not None) and (self.tracks[0] == t1) and not self.needs_redetect(self.tracks[1]):
+            pts1 = self.tracks[1]
+        else:
+            pts1 = cv2.goodFeaturesToTrack(gray1, self.max_tracks, 0.01, 8)
+            if pts1 is None:
+                self.tracks = None
+                raise Exception('No corners to track!')
+        (pts2, status, err) = cv2.calcOpticalFlowPyrLK(gray1, gray2, pts1, None, **self.LK_PARAMS)
+        # Forward-backward check to drop tracks which drifted
+        (back, status_back, err) = cv2.calcOpticalFlowPyrLK(gray2, gray1, pts2, None, **self.LK_PARAMS)
+        drift = np.abs(back - pts1).reshape(-1, 2).max(axis=1)
+        good = (status.ravel() == 1) & (status_back.ravel() == 1) & (drift < 1.0)
+        self.tracks = (t2, pts2[good])
+        pts1 = pts1[good].reshape(-1, 2)
+        pts2 = pts2[good].reshape(-1, 2)
+        pairs = np.concatenate((pts1[:, None], pts2[:, None]), axis=1)
+        dists = self.distances(pts1, pts2, project=True)
+        v_best = self.filter_speeds(dists, dt, p_min=p_min, p_max=p_max)
+        return (v_best, pairs, bgr1, bgr2)
     
+    """
+    Record
+    Store `frames` camera frames and their features to a FeatureCache at path
+    """
+    def record(self, path, frames=100):
+        cache = FeatureCache(path)
+        key = self.detector_key()
+        for i in range(frames):
+            [(t, bgr)] = self.read_frames(1)
+            if bgr is None:
+                break
+            gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+            h = cache.add_frame(t, gray)
+            cache.store(h, key, self.detect_features(gray))
+        cache.save()
+        return cache
+
+    """
+    Replay
+    Generate (v_best, pairs, gray1, gray2) for each consecutive pair of frames
+    of a FeatureCache, feeding the cached features straight into the matching
+    and projection stages of the FEATURES or RIGID engine. Features missing for
+    the current detector settings are detected once and added to the cache.
+    Optional arguments:
+        dt : the time between each frame, the recorded times if None
+    """
+    def replay(self, cache, dt=None, p_min=5, p_max=95):
+        if self.engine == 'FEATURES':
+            match = self.match_vector
+        elif self.engine == 'RIGID':
+            match = self.match_rigid
+        else:
+            raise Exception("Cannot replay features with the %s engine" % self.engine)
+        if not isinstance(cache, FeatureCache):
+            cache = FeatureCache(cache)
+        key = self.detector_key()
+        previous = None
+        for (t, h) in cache.order:
+            features = cache.lookup(h, key)
+            if features is None:
+                features = self.detect_features(cache.frames[h])
+                cache.store(h, key, features)
+            if previous is not None:
+                (t1, h1, features1) = previous
+                try:
+                    (v_best, pairs) = match(features1, features, dt or (t - t1), p_min=p_min, p_max=p_max)
+                    yield (v_best, pairs, cache.frames[h1], cache.frames[h])
+                except Exception as e:
+                    pretty_print('CV6', 'Replay failed: %s' % str(e))
+            previous = (t, h, features)
+
+    """
+    Estimates
+    Generate (v_best, pairs, bgr1, bgr2) with the current engine, in capture order
+    Optional arguments:
+        dt : the time between each frame
+        workers : number of worker processes, 0 to estimate in this process
+        max_failures : consecutive failed estimates before giving up, e.g. on a
+            dead camera or the end of a file
+        retry : seconds to wait after a failed estimate
+    With workers, frame pairs are handed to a process pool with up to two pairs
+    in flight per worker, so the capture thread should be running
+    Failed estimates are logged and skipped, so the generator keeps running
+    """
+    def estimates(self, dt=None, p_min=5, p_max=95, workers=0, max_failures=10, retry=0.1):
+        if not workers:
+            failures = 0
+            while True:
+                if not self.streaming:
+                    self.flush() # streaming needs consecutive frames
+                try:
+                    estimate = self.estimator(dt=dt, p_min=p_min, p_max=p_max)
+                except Exception as e:
+                    failures += 1
+                    pretty_print('CV6', str(e))
+                    if failures >= max_failures:
+                        raise Exception('%d estimates failed in a row, last: %s' % (failures, str(e)))
+                    time.sleep(retry)
+                    continue
+                failures = 0
+                yield estimate
+        pool = multiprocessing.Pool(workers, init_worker, (self.settings(), self.guidance(), self.rectify))
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < 2 * workers:
+                    frames = self.read_frames(2)
+                    job = pool.apply_async(estimate_worker, (frames, dt, p_min, p_max))
+                    pending.append((frames, job))
+                (frames, job) = pending.popleft()
+                try:
+                    (v_best, pairs) = job.get()
+                except Exception as e:
+                    pretty_print('CV6', 'Worker failed: %s' % str(e))
+                    continue
+                yield (v_best, pairs, frames[0][1], frames[1][1])
+        finally:
+            pool.terminate()
+
     """
     Run the matching algorithm directly on a video source or file
     Optional Arguments:
         dt : the time between each frame
+        logging : log each estimate to a file named by the `name` date format
+        binary : log to a binary session log (see SessionLog) instead of CSV
+        gps : add the latest fix from gpsd to each log entry
     """
-    def run(self, dt=None, display=False, logging=False, name="%m-%d %H:%M.csv", gps=False, ultrasonic=False):
+    def run(self, dt=None, display=False, logging=False, name=None, gps=False, ultrasonic=False, binary=False):
         if gps:
-            try:
-                self.gps = gpsd.gps()
-                self.gps.stream()
-            except Exception as e:
-                raise e
-                self.gps = None
+            self.gps = GPSReader()
+            self.gps.start()
         else:
-            self.gps = gps
+            self.gps = None
         if ultrasonic:
             pass #TODO add ultrasonic
+        if display:
+            viewer = Display(self.w, self.h)
+            viewer.start()
         if logging:
-            logname = datetime.strftime(datetime.now(), name)
-            logfile = open(logname, 'w')
-        while True:
-            try:
-                (v_best, pairs, bgr1, bgr2) = self.estimate_vector(dt=dt)
+            if binary:
+                logname = datetime.strftime(datetime.now(), name or "%m-%d %H:%M.bin")
+                logfile = SessionLog(logname)
+            else:
+                logname = datetime.strftime(datetime.now(), name or "%m-%d %H:%M.csv")
+                logfile = open(logname, 'w')
+        try:
+            while True:
+                (v_best, pairs, bgr1, bgr2) = self.estimator(dt=dt)
                 if display:
-                    output = np.array(np.hstack((bgr1, bgr2)))
-                    for ((x1,y1), (x2,y2)) in pairs:
-                        pt1 = (int(x1), int(y1))
-                        pt2 = (int(x1 + self.w), int(y2))
-                        cv2.circle(output, pt1, 5, (0,0,255), 2)
-                        cv2.circle(output, pt2, 5, (0,255,0), 2)
-                        cv2.line(output, pt1, pt2, (255,0,0), 1)
-                    cv2.imshow("", output)
-                    if cv2.waitKey(5) == 5:
+                    if viewer.closed:
                         break
+                    viewer.show(pairs, bgr1, bgr2)
                 if logging:
-                    datetime.strftime(datetime.now(), name)
-                    newline = []
                     if self.gps is not None:
-                        self.gps.next()
-                        lon = self.gps.fix.longitude
-                        lat = self.gps.fix.latitude
-                        alt = self.gps.fix.altitude
-                        print("%f N\t%f E\t%f m\t%f m/s" % (lat, lon, alt, v_best.mean()))
-                        gps_data = [str(g) for g in [lon, lat, alt]] #TODO add more gps data
-                        newline = newline + gps_data
-                        
-                    v_best = [str(v) for v in v_best.tolist()]
-                    newline = newline + v_best
-                    newline.append('\n')
-                    logfile.write(','.join(newline))
-            except Exception as e:
-                raise e
-            except KeyboardInterrupt as e:
-                self.close()
-                break
-                
+                        fix = self.gps.latest()
+                    else:
+                        fix = (np.nan, np.nan, np.nan)
+                    if binary:
+                        logfile.append(time.time(), v_best, len(pairs), fix) # wall clock, to line up with the GPS and OBD logs
+                    else:
+                        newline = []
+                        if self.gps is not None:
+                            (lat, lon, alt) = fix
+                            print("%f N\t%f E\t%f m\t%f m/s" % (lat, lon, alt, v_best.mean()))
+                            gps_data = [str(g) for g in [lon, lat, alt]] #TODO add more gps data
+                            newline = newline + gps_data
+                        v_best = [str(v) for v in v_best.tolist()]
+                        newline = newline + v_best
+                        newline.append('\n')
+                        logfile.write(','.join(newline))
+        except KeyboardInterrupt as e:
+            pass
+        finally:
+            if display:
+                viewer.stop()
+            if logging:
+                logfile.close()
+            if self.gps is not None:
+                self.gps.stop()
+            self.close()
+
     """
     Run algorithm with buffer flushing
     This compensates for the relatively slow pace of the algorithm
     WARNING: this function is meant to be used with a LIVE VIDEO STREAM ONLY
+    With workers > 0, the estimation runs in a process pool, see estimates()
+    With a QualityController (see set_quality) and no workers, the processing
+    time of each estimate, without the time spent waiting for frames, drives
+    the quality level, which is reported with each event
     """
-    def run_async(self, N=3, dt=None, precision=2, uid='CV6', task='push', zmq_addr="tcp://127.0.0.1:1980", zmq_timeout=0.1):
-        self.zmq_addr = zmq_addr
-        self.zmq_timeout = zmq_timeout
-        self.zmq_context = zmq.Context()
-        self.zmq_client = self.zmq_context.socket(zmq.REQ)
-        self.zmq_client.connect(self.zmq_addr)
-        self.zmq_poller = zmq.Poller()
-        self.zmq_poller.register(self.zmq_client, zmq.POLLIN)
+    def run_async(self, N=3, dt=None, precision=2, uid='CV6', task='push', zmq_addr="tcp://127.0.0.1:1980", zmq_timeout=0.1, workers=0):
+        self.publisher = Publisher(zmq_addr, timeout=zmq_timeout)
+        self.publisher.start()
         v_hist = [0] * N
+        estimates = self.estimates(dt=dt, workers=workers)
         for i in cycle(range(N)):
             try:
-                self.flush()
-                (v_best, pairs, bgr1, bgr2) = self.estimate_vector(dt=dt)
+                (t, waited) = (clock(), self.waited)
+                (v_best, pairs, bgr1, bgr2) = next(estimates)
+                if (self.quality is not None) and not workers:
+                    if self.quality.update((clock() - t) - (self.waited - waited)):
+                        self.apply_quality()
                 v_hist[i] = np.median(v_best)
                 v_avg = round(np.mean(v_hist), precision)
                 event = {
@@ -390,32 +1652,176 @@ class V6:
                         'v_avg' : v_avg
                     }
                 }
+                if self.quality is not None:
+                    event['data']['quality'] = self.quality.level
                 pretty_print('CV6', '%s' % str(event))
-                try:
-                    dump = json.dumps(event)
-                    self.zmq_client.send(dump)
-                    time.sleep(self.zmq_timeout)
-                    socks = dict(self.zmq_poller.poll(self.zmq_timeout))
-                    if socks:
-                        if socks.get(self.zmq_client) == zmq.POLLIN:
-                            dump = self.zmq_client.recv(zmq.NOBLOCK) # zmq.NOBLOCK
-                            response = json.loads(dump)
-                            pretty_print('CV6', 'Received: %s' % str(response))
-                        else:
-                            pass
-                    else:
-                        pass
-                except Exception as err:
-                    pretty_print('CV6', str(err))
-                except KeyboardInterrupt as err:
-                    raise KeyboardInterrupt
+                self.publisher.publish(event) # never blocks, stale events are dropped
+            except KeyboardInterrupt:
+                raise KeyboardInterrupt
+
+"""
+Rig
+Several cameras driven by one V6 process. Each camera is a V6 with its own
+capture thread and projection geometry; every cycle the newest pair of each
+camera is estimated on a shared pool of threads (OpenCV releases the GIL, so
+the cameras run on separate cores) and the estimates are fused into a single
+speed and yaw rate of the vehicle.
+Required arguments:
+    cameras : [ (V6, mount), ... ] where mount is (x, y, yaw) of the camera in
+        the vehicle frame (meters, meters, rad), x forward and y left
+Optional arguments:
+    workers : number of threads, defaults to one per camera
+"""
+class Rig:
+
+    def __init__(self, cameras, workers=None):
+        if not cameras:
+            raise Exception("Cannot run a rig without cameras")
+        self.cameras = cameras
+        self.pool = ThreadPool(workers or len(cameras))
+        self.publisher = None
+        self.motion = None # (vx, vy, omega) in m/s and rad/s
+
+    """
+    Estimate camera i, failures are logged and returned as None so that a
+    single camera without matches does not drop the whole cycle
+    Returns: (v_best, motion) or None
+    """
+    def step(self, i, dt=None, p_min=5, p_max=95):
+        (ext, mount) = self.cameras[i]
+        try:
+            (v_best, pairs, bgr1, bgr2) = ext.estimator(dt=dt, p_min=p_min, p_max=p_max)
+            return (v_best, ext.motion)
+        except Exception as e:
+            pretty_print('CV6', 'Camera %d failed: %s' % (i, str(e)))
+            return None
+
+    """
+    Fuse the per-camera estimates into a motion of the vehicle
+    A camera at (x, y) sees the ground move against the vehicle velocity at its
+    mount, (vx - omega*y, vy + omega*x), and turn against the yaw rate. The
+    ground frame of a camera (X to the image right, Y down the rows) has the
+    opposite handedness to the vehicle frame (x forward, y left), so its Y and
+    rotation are reflected before turning it by the mount yaw; the
+    cameras with a rigid fit (RIGID engine) are solved for (vx, vy, omega) by
+    least squares. Without any rigid fit, the speed is the mean of the camera
+    medians and the yaw rate is unknown.
+    Returns: (v, omega) in km/hr and rad/s, omega is None if unknown
+    """
+    def fuse(self, results):
+        A = []
+        b = []
+        speeds = []
+        for ((ext, (x, y, yaw)), result) in zip(self.cameras, results):
+            if result is None:
+                continue
+            (v_best, motion) = result
+            speeds.append(np.median(v_best))
+            if motion is None:
+                continue
+            (v, heading, omega) = motion
+            (c, s) = (np.cos(yaw), np.sin(yaw))
+            (gx, gy) = (-v / 3.6 * np.cos(heading), v / 3.6 * np.sin(heading)) # vehicle velocity at the mount, camera frame with Y reflected
+            A += [[1, 0, -y], [0, 1, x], [0, 0, 1]]
+            b += [c * gx - s * gy, s * gx + c * gy, omega]
+        if not speeds:
+            raise Exception('No camera produced an estimate!')
+        if not A:
+            self.motion = None
+            return (np.mean(speeds), None)
+        self.motion = np.linalg.lstsq(np.array(A, dtype=np.float64), np.array(b), rcond=-1)[0]
+        (vx, vy, omega) = self.motion
+        return (3.6 * np.sqrt(vx**2 + vy**2), omega)
+
+    """
+    Estimate every camera once and fuse the results
+    Returns: (v, omega, results)
+    """
+    def estimate(self, dt=None, p_min=5, p_max=95):
+        results = self.pool.map(lambda i: self.step(i, dt, p_min, p_max), range(len(self.cameras)))
+        (v, omega) = self.fuse(results)
+        return (v, omega, results)
+
+    """
+    Run the rig against the OBD, same as V6.run_async with the yaw rate added
+    """
+    def run_async(self, N=3, dt=None, precision=2, uid='CV6', task='push', zmq_addr="tcp://127.0.0.1:1980", zmq_timeout=0.1):
+        self.publisher = Publisher(zmq_addr, timeout=zmq_timeout)
+        self.publisher.start()
+        v_hist = [0] * N
+        for i in cycle(range(N)):
+            try:
+                (v, omega, results) = self.estimate(dt=dt)
             except KeyboardInterrupt:
                 raise KeyboardInterrupt
+            except Exception as e:
+                pretty_print('CV6', str(e))
+                continue
+            v_hist[i] = v
+            data = {
+                'v_avg' : round(np.mean(v_hist), precision),
+                'cameras' : len([r for r in results if r is not None])
+            }
+            if omega is not None:
+                data['yaw_rate'] = round(omega, precision + 2)
+            event = {
+                'uid' : uid,
+                'task' : task,
+                'data' : data
+            }
+            pretty_print('CV6', '%s' % str(event))
+            self.publisher.publish(event)
+
+    """
+    Close
+    """
+    def close(self):
+        if self.publisher is not None:
+            self.publisher.stop()
+            self.publisher = None
+        self.pool.terminate()
+        for (ext, mount) in self.cameras:
+            ext.close()
+
+"""
+Worker Processes
+Each worker of V6.estimates() holds its own camera-less V6 with the same setup
+"""
+worker = None
+
+def init_worker(settings, guidance, rectify):
+    global worker
+    worker = V6(capture=None, **settings)
+    worker.set_engine(settings['engine'], rectify=rectify)
+    worker.set_guidance(**guidance)
+
+def estimate_worker(frames, dt, p_min, p_max):
+    (v_best, pairs, bgr1, bgr2) = worker.estimator(dt=dt, p_min=p_min, p_max=p_max, frames=frames)
+    return (v_best, pairs) # the frames stay in the parent
 
 if __name__ == '__main__':
+    with open('config/V6_v1.json', 'r') as jsonfile:
+        config = json.loads(jsonfile.read()) # Load settings file
+    guidance = config['GUIDANCE']
     try:
-        ext = V6(capture=0)
-        ext.run_async(dt=1/25.0)
+        if config['CAMERAS']:
+            cameras = []
+            for camera in config['CAMERAS']:
+                settings = dict(config['SETTINGS'], **camera['SETTINGS']) # per-camera geometry
+                cam = V6(capture=camera['CAM_ID'], streaming=True, threaded=True, **settings)
+                cam.set_engine(camera.get('ENGINE', config['ENGINE']), rectify=config['RECTIFY'])
+                cam.set_guidance(max_keypoints=guidance['MAX_KEYPOINTS'], grid=guidance['GRID'], window=guidance['WINDOW'])
+                cameras.append((cam, camera['MOUNT']))
+            ext = Rig(cameras)
+            ext.run_async()
+        else:
+            ext = V6(capture=config['CAM_ID'], streaming=True, threaded=True, **config['SETTINGS'])
+            ext.set_engine(config['ENGINE'], rectify=config['RECTIFY'])
+            ext.set_guidance(max_keypoints=guidance['MAX_KEYPOINTS'], grid=guidance['GRID'], window=guidance['WINDOW'])
+            quality = config['QUALITY']
+            if quality['RATE']:
+                ext.set_quality(QualityController(quality['RATE'], levels=quality['LEVELS'], hessian=quality['HESSIAN'], features=quality['FEATURES'], threshold=quality['THRESHOLD'], scale=quality['SCALE'], settle=quality['SETTLE']))
+            ext.run_async(workers=config['WORKERS'])
     except Exception as e:
-	print str(e)
+        print str(e)
         ext.close()
@@ -0,0 +1,209 @@
+"""
+V6 Benchmark
+
+Replays a recorded clip, or synthetic ground texture moving at a known speed,
+through V6 with no camera attached. Each stage of the FEATURES engine is timed
+(grayscale, detection, knnMatch, ratio test, projection, percentile filter) and
+the estimates/sec and speed error are reported for every backend and engine.
+With --window, the knn stage times guided matching, ratio test included.
+
+Usage:
+    python bench.py clip.avi --speed 5.0 --fps 25
+    python bench.py --synthetic --speed 1.0 --fps 25
+    python bench.py --synthetic --speed 1.0 --top-k 300 --window 20
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+import cv2
+import numpy as np
+import argparse
+from V6 import V6, BACKENDS, ENGINES, clock, pretty_print
+
+STAGES = ['gray', 'detect', 'knn', 'ratio', 'project', 'filter']
+
+"""
+Load a recorded clip into memory, so decoding is not part of the timing
+Returns: [ bgr, ... ] resized to the frame size of ext
+"""
+def load_clip(ext, path, frames=200):
+    video = cv2.VideoCapture(path)
+    clip = []
+    while len(clip) < frames:
+        (s, bgr) = video.read()
+        if not s:
+            break
+        if bgr.shape[:2] != (ext.h, ext.w):
+            bgr = cv2.resize(bgr, (ext.w, ext.h))
+        clip.append(bgr)
+    video.release()
+    return clip
+
+"""
+Synthetic ground texture seen through the camera setup of ext
+The texture moves along the direction of travel by exactly speed * dt on the
+ground plane each frame, and every pixel is placed with project_many(), so the
+true speed of the clip is known for any fov, d and pitch
+Returns: [ bgr, ... ]
+"""
+def synthetic_clip(ext, speed, fps, frames=200, seed=0):
+    (rows, Y, scale) = ext.projection_table()
+    (u, v) = np.meshgrid(np.arange(ext.w), np.arange(ext.h))
+    ground = ext.project_many(np.column_stack((u.ravel(), v.ravel())))
+    res = scale.min() # ground distance of one texture pixel
+    step = (speed * 1000.0 / 3.6) / fps / res # texture pixels travelled per frame
+    mapx = np.float32(ground[:, 0].reshape(ext.h, ext.w) / res)
+    mapy = np.float32((ground[:, 1].reshape(ext.h, ext.w) - Y[0]) / res)
+    height = int(mapy.max() + step * frames) + 2
+    width = int(mapx.max()) + 2
+    noise = np.random.RandomState(seed).rand(height, width).astype(np.float32)
+    texture = cv2.normalize(cv2.GaussianBlur(noise, (0, 0), 1.5), None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    clip = []
+    for k in range(frames):
+        gray = cv2.remap(texture, mapx, mapy + np.float32(k * step), cv2.INTER_LINEAR)
+        clip.append(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+    return clip
+
+"""
+Camera-less feed of a clip, read by V6 in place of a camera
+Returns: (True, bgr) for each frame in order, then (False, None)
+"""
+class ClipFeed:
+
+    def __init__(self, clip):
+        self.frames = iter(clip)
+
+    def read(self):
+        bgr = next(self.frames, None)
+        return (bgr is not None, bgr)
+
+"""
+Replay a clip through ext in streaming order
+The FEATURES engine is run stage by stage to time each of STAGES, the other
+engines are only timed as a whole, streaming from a ClipFeed so that every
+engine prepares each frame once
+Required arguments:
+    ext : V6 instance, can be camera-less
+    clip : [ bgr, ... ]
+    dt : time between frames
+Optional arguments:
+    speed : true speed of the clip (km/hr), None if unknown
+Returns:
+    result : dict of the stage times (ms per frame), rate and error
+"""
+def profile(ext, clip, dt, speed=None, p_min=5, p_max=95):
+    stages = dict((s, 0.0) for s in STAGES)
+    ext.prior = None # no motion prior from an earlier run
+    estimates = []
+    failed = 0
+    previous = None
+    (camera, streaming) = (ext.camera, ext.streaming)
+    ext.camera = ClipFeed(clip)
+    ext.set_streaming(True)
+    a = clock()
+    for (bgr1, bgr2) in zip(clip[:-1], clip[1:]):
+        try:
+            if ext.engine == 'FEATURES':
+                if previous is None:
+                    previous = ext.detect_features(bgr1)
+                t = clock()
+                gray = cv2.cvtColor(bgr2, cv2.COLOR_BGR2GRAY)
+                stages['gray'] += clock() - t
+                t = clock()
+                features = ext.detect_features(gray)
+                stages['detect'] += clock() - t
+                previous_features = previous
+                (pts1, desc1) = previous
+                (pts2, desc2) = features
+                previous = features
+                if ext.guide_window:
+                    t = clock()
+                    (good1, good2) = ext.match_pairs(previous_features, features, dt) # guided, ratio test included
+                    stages['knn'] += clock() - t
+                else:
+                    t = clock()
+                    all_matches = ext.knn_match(desc1, desc2)
+                    stages['knn'] += clock() - t
+                    t = clock()
+                    (good1, good2) = ext.ratio_test(all_matches, pts1, pts2)
+                    stages['ratio'] += clock() - t
+                t = clock()
+                dists = ext.distances(good1, good2, project=True)
+                stages['project'] += clock() - t
+                t = clock()
+                v_best = ext.filter_speeds(dists, dt, p_min=p_min, p_max=p_max)
+                stages['filter'] += clock() - t
+            else:
+                (v_best, pairs, bgr1, bgr2) = ext.estimator(dt=dt, p_min=p_min, p_max=p_max)
+            estimates.append(np.median(v_best))
+        except Exception as e:
+            failed += 1 # too few matches to estimate
+    elapsed = clock() - a
+    ext.camera = camera
+    ext.set_streaming(streaming)
+    pairs = max(len(clip) - 1, 1)
+    estimates = np.array(estimates)
+    errors = np.abs(estimates - speed) if (speed is not None) else np.array([])
+    result = {
+        'backend' : ext.backend if ext.engine in ('FEATURES', 'RIGID') else '-',
+        'matcher' : ('FLANN' if ext.use_flann else 'BF') if ext.engine in ('FEATURES', 'RIGID') else '-',
+        'engine' : ext.engine,
+        'estimates' : len(estimates),
+        'failed' : failed,
+        'rate' : pairs / float(elapsed),
+        'error' : errors.mean() if len(errors) else float('nan'),
+        'rmse' : np.sqrt(np.mean(errors**2)) if len(errors) else float('nan'),
+    }
+    for s in STAGES:
+        result[s] = 1000.0 * stages[s] / pairs
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded or synthetic ground footage through V6')
+    parser.add_argument('clip', nargs='?', help='recorded clip, not needed with --synthetic')
+    parser.add_argument('--synthetic', action='store_true', help='generate ground texture moving at --speed')
+    parser.add_argument('--speed', type=float, help='true speed of the clip (km/hr)')
+    parser.add_argument('--fps', type=float, default=25.0)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--engines', nargs='+', default=['FEATURES'], choices=ENGINES)
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--flann', action='store_true', help='also benchmark the FLANN matchers')
+    parser.add_argument('--top-k', type=int, default=0, help='keep the K strongest keypoints, bucketed over the frame')
+    parser.add_argument('--window', type=float, default=0, help='guided matching search window [px]')
+    parser.add_argument('--fov', type=float, default=0.75)
+    parser.add_argument('--depth', type=float, default=241)
+    parser.add_argument('--pitch', type=float, default=0)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    args = parser.parse_args()
+    if args.synthetic and (args.speed is None):
+        parser.error('--synthetic needs --speed')
+    if not (args.synthetic or args.clip):
+        parser.error('give a clip or --synthetic')
+    geometry = dict(fov=args.fov, d=args.depth, pitch=args.pitch, w=args.width, h=args.height)
+    ext = V6(capture=None, **geometry)
+    ext.set_guidance(max_keypoints=args.top_k, window=args.window)
+    if args.synthetic:
+        clip = synthetic_clip(ext, args.speed, args.fps, frames=args.frames)
+    else:
+        clip = load_clip(ext, args.clip, frames=args.frames)
+    pretty_print('BENCH', 'Replaying %d frames' % len(clip))
+    results = []
+    for engine in args.engines:
+        if engine in ('FEATURES', 'RIGID'):
+            setups = [(b, f) for b in args.backends for f in ([False, True] if args.flann else [False])]
+        else:
+            setups = [('SURF', False)]
+        for (backend, use_flann) in setups:
+            ext.set_matcher(ext.hessian, use_flann=use_flann, backend=backend)
+            ext.set_engine(engine)
+            r = profile(ext, clip, 1.0 / args.fps, speed=args.speed)
+            pretty_print('BENCH', '%s %s/%s done' % (r['engine'], r['backend'], r['matcher']))
+            results.append(r)
+    header = ['ENGINE', 'BACKEND', 'MATCH', 'EST/S', 'FAILED', 'ERR km/h', 'RMSE'] + [s + ' ms' for s in STAGES]
+    print(' '.join(['%10s' % h for h in header]))
+    for r in sorted(results, key=lambda r: -r['rate']):
+        row = ['%10s' % r['engine'], '%10s' % r['backend'], '%10s' % r['matcher'], '%10.2f' % r['rate'], '%10d' % r['failed'], '%10.3f' % r['error'], '%10.3f' % r['rmse']]
+        row += ['%10.2f' % r[s] for s in STAGES]
+        print(' '.join(row))
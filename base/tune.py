@@ -0,0 +1,196 @@
+"""
+V6 Tuner
+
+Searches the V6 parameters (hessian, factor, neighbors, frame size and the
+projection geometry) on a recorded clip of known speed, or on synthetic ground
+texture, across all cores. Candidates which differ only in the matching and
+geometry share one detection pass: each group of the same frame size and
+detector (see V6.detector_key) detects the clip once into a FeatureCache and
+every candidate of the group replays it (see V6.replay). Reports the Pareto
+front of estimates/sec against speed error and writes the chosen settings to
+the SETTINGS of a V6 config file.
+
+Usage:
+    python tune.py clip.avi --speed 5.0 --fps 25 --max-error 0.2
+    python tune.py --synthetic --speed 1.0 --samples 40
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+import cv2
+import argparse
+import itertools
+import json
+import random
+import multiprocessing
+import numpy as np
+from V6 import V6, FeatureCache, BACKENDS, clock, pretty_print
+from bench import load_clip, synthetic_clip
+
+# Search space, each candidate takes one value of each key
+SPACE = {
+    'backend' : BACKENDS,
+    'hessian' : [300, 500, 1000, 2000],
+    'factor' : [0.5, 0.6, 0.7, 0.8],
+    'neighbors' : [2, 3],
+    'size' : [(320, 240), (480, 360), (640, 480)],
+}
+
+"""
+Candidate Settings
+Returns: list of dicts, the full grid or `samples` random points of it
+"""
+def candidates(space, samples=None, seed=0):
+    keys = sorted(space.keys())
+    grid = [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+    grid = [c for c in grid if (c['backend'] == 'SURF') or (c['hessian'] == space['hessian'][0])] # hessian is SURF only
+    if samples and (samples < len(grid)):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+"""
+Pareto Front
+Returns: the results which no other result beats on both rate and error
+"""
+def pareto_front(results):
+    front = []
+    best_error = float('inf')
+    for r in sorted(results, key=lambda r: (-r['rate'], r['error'])):
+        if r['error'] < best_error:
+            front.append(r)
+            best_error = r['error']
+    return front
+
+"""
+Candidate Groups
+Returns: lists of candidates with the same frame size and detector, in order
+"""
+def group_candidates(jobs):
+    groups = {}
+    for c in jobs:
+        (w, h) = c['size']
+        ext = V6(capture=None, hessian=c.get('hessian', 1000), backend=c.get('backend', 'SURF'), w=w, h=h)
+        groups.setdefault(((w, h), ext.detector_key()), []).append(c)
+    return [groups[k] for k in sorted(groups.keys())]
+
+"""
+Worker Processes
+Each worker loads the clip once, keeps a FeatureCache of it per frame size,
+and evaluates groups of candidates on it
+"""
+clip = None
+config = None
+caches = {} # (w, h) : FeatureCache
+
+def init_tuner(tuner_config):
+    global clip, config
+    config = tuner_config
+    ext = V6(capture=None, **config['geometry'])
+    if config['synthetic']:
+        clip = synthetic_clip(ext, config['speed'], config['fps'], frames=config['frames'])
+    else:
+        clip = load_clip(ext, config['clip'], frames=config['frames'])
+
+def clip_cache(w, h):
+    if (w, h) not in caches:
+        cache = FeatureCache(None)
+        for (k, bgr) in enumerate(clip):
+            if (w, h) != (bgr.shape[1], bgr.shape[0]):
+                bgr = cv2.resize(bgr, (w, h))
+            cache.add_frame(k / config['fps'], cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY))
+        caches[(w, h)] = cache
+    return caches[(w, h)]
+
+"""
+Evaluate a group of candidates sharing one detection pass
+The detection time of the group is added to the matching time of each
+candidate, so the rates are those of estimating the clip in streaming order
+Returns: [ result, ... ] with the rate and error of each candidate
+"""
+def evaluate(group):
+    (w, h) = group[0]['size']
+    cache = clip_cache(w, h)
+    pairs = max(len(cache.order) - 1, 1)
+    detect = None
+    results = []
+    for candidate in group:
+        settings = dict((k, v) for (k, v) in candidate.items() if k != 'size')
+        settings.update(w=w, h=h)
+        try:
+            ext = V6(capture=None, **settings)
+            if detect is None:
+                key = ext.detector_key()
+                t = clock()
+                for (t_frame, f) in cache.order:
+                    if cache.lookup(f, key) is None:
+                        cache.store(f, key, ext.detect_features(cache.frames[f]))
+                detect = clock() - t
+            t = clock()
+            estimates = np.array([np.median(v_best) for (v_best, matched, gray1, gray2) in ext.replay(cache, dt=1.0 / config['fps'])])
+            elapsed = detect + (clock() - t)
+            errors = np.abs(estimates - config['speed'])
+            r = {
+                'estimates' : len(estimates),
+                'failed' : pairs - len(estimates),
+                'rate' : pairs / float(elapsed),
+                'error' : errors.mean() if len(errors) else float('inf'),
+                'rmse' : np.sqrt(np.mean(errors**2)) if len(errors) else float('inf'),
+            }
+        except Exception as e:
+            r = {'rate' : 0.0, 'error' : float('inf'), 'failed' : len(clip)}
+        r['settings'] = settings
+        results.append(r)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search V6 parameters for the best throughput/accuracy tradeoff')
+    parser.add_argument('clip', nargs='?', help='recorded clip, not needed with --synthetic')
+    parser.add_argument('--synthetic', action='store_true', help='generate ground texture moving at --speed')
+    parser.add_argument('--speed', type=float, required=True, help='true speed of the clip (km/hr)')
+    parser.add_argument('--fps', type=float, default=25.0)
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--samples', type=int, help='random search over this many candidates instead of the grid')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--max-error', type=float, help='pick the fastest setting under this error (km/hr)')
+    parser.add_argument('--fov', type=float, nargs='+', default=[0.75])
+    parser.add_argument('--depth', type=float, nargs='+', default=[241])
+    parser.add_argument('--pitch', type=float, nargs='+', default=[0])
+    parser.add_argument('--config', default='config/V6_v1.json', help='V6 config file to write the chosen SETTINGS to')
+    parser.add_argument('--dry-run', action='store_true', help='only report, do not write the config')
+    args = parser.parse_args()
+    if not (args.synthetic or args.clip):
+        parser.error('give a clip or --synthetic')
+    space = dict(SPACE, fov=args.fov, d=args.depth, pitch=args.pitch)
+    geometry = dict(fov=args.fov[0], d=args.depth[0], pitch=args.pitch[0], w=max(w for (w, h) in SPACE['size']), h=max(h for (w, h) in SPACE['size']))
+    tuner_config = dict(clip=args.clip, synthetic=args.synthetic, speed=args.speed, fps=args.fps, frames=args.frames, geometry=geometry)
+    jobs = candidates(space, samples=args.samples)
+    groups = group_candidates(jobs)
+    pretty_print('TUNE', 'Evaluating %d candidates in %d detector groups on %d workers' % (len(jobs), len(groups), args.workers))
+    pool = multiprocessing.Pool(args.workers, init_tuner, (tuner_config,))
+    try:
+        results = [r for group in pool.map(evaluate, groups) for r in group]
+    finally:
+        pool.terminate()
+    front = pareto_front(results)
+    if not front:
+        raise SystemExit('No candidate produced an estimate')
+    print("%10s %10s %8s  %s" % ('EST/S', 'ERR km/h', 'FAILED', 'SETTINGS'))
+    for r in front:
+        print("%10.2f %10.3f %8d  %s" % (r['rate'], r['error'], r['failed'], json.dumps(r['settings'], sort_keys=True)))
+    if args.max_error is not None:
+        accepted = [r for r in front if r['error'] <= args.max_error]
+    else:
+        accepted = []
+    if accepted:
+        chosen = accepted[0] # the front is sorted fastest first
+    else:
+        chosen = min(front, key=lambda r: r['error'])
+    pretty_print('TUNE', 'Chose %s' % json.dumps(chosen['settings'], sort_keys=True))
+    if not args.dry_run:
+        with open(args.config, 'r') as jsonfile:
+            v6_config = json.loads(jsonfile.read())
+        v6_config['SETTINGS'] = chosen['settings']
+        with open(args.config, 'w') as jsonfile:
+            jsonfile.write(json.dumps(v6_config, indent=4, sort_keys=True))
+        pretty_print('TUNE', 'Saved to %s' % args.config)
@@ -463,7 +463,7 @@ int check_rfid(void) {
 /// Checksum
 int checksum() {
   int sum = 0;
-  for (int i = 0; i < DATA_SIZE; i++) {
+  for (int i = 0; (i < DATA_SIZE) && DATA_BUFFER[i]; i++) { // up to the terminator, stale bytes follow shorter lines
     sum += DATA_BUFFER[i];
   }
   int val = sum % 256;
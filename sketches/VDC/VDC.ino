@@ -190,7 +190,7 @@ void loop() {
 // Check sum
 int checksum() {
   int sum = 0;
-  for (int i = 0; i < DATA_SIZE; i++) {
+  for (int i = 0; (i < DATA_SIZE) && DATA_BUFFER[i]; i++) { // up to the terminator, stale bytes follow shorter lines
     sum += DATA_BUFFER[i];
   }
   int val = sum % 256;
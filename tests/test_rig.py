@@ -0,0 +1,49 @@
+"""
+Motion fusion of the V6 camera rig
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'base'))
+try:
+    import numpy as np
+    from V6 import Rig
+except ImportError: # V6 needs OpenCV
+    Rig = None
+
+"""
+Ground motion which a camera at mount (x, y, yaw) sees while the vehicle turns
+at omega (rad/s) in place, as (v, heading, omega) of V6.match_rigid: image
+ground frame with X to the right and Y down the rows
+"""
+def pure_yaw(mount, omega, dt=0.01):
+    (x, y, yaw) = mount
+    def image(p, a):
+        (c, s) = (np.cos(-a), np.sin(-a))
+        p = np.array([c * p[0] - s * p[1], s * p[0] + c * p[1]]) - np.array([x, y]) # vehicle frame after turning by a
+        (c, s) = (np.cos(-yaw), np.sin(-yaw))
+        q = np.array([c * p[0] - s * p[1], s * p[0] + c * p[1]]) # camera frame
+        return np.array([q[0], -q[1]]) # reflected into the image
+    ground = [np.array([x, y]), np.array([x, y]) + np.array([np.cos(yaw), np.sin(yaw)])]
+    (p1, p2) = ([image(p, 0.0) for p in ground], [image(p, omega * dt) for p in ground])
+    shift = p2[0] - p1[0]
+    theta = np.arctan2((p2[1] - p2[0])[1], (p2[1] - p2[0])[0]) - np.arctan2((p1[1] - p1[0])[1], (p1[1] - p1[0])[0])
+    return (3.6 * np.sqrt(np.sum(shift**2)) / dt, np.arctan2(shift[1], shift[0]), theta / dt)
+
+@unittest.skipIf(Rig is None, 'OpenCV is not installed')
+class TestRigFuse(unittest.TestCase):
+
+    def fuse(self, mounts, omega):
+        rig = Rig([(None, mount) for mount in mounts], workers=1)
+        return rig.fuse([(np.array([0.0]), pure_yaw(mount, omega)) for mount in mounts])
+
+    def test_pure_yaw_sign(self):
+        mounts = [(1.0, 0.5, 0.0), (-1.0, -0.5, np.pi / 2)]
+        for omega in (0.5, -0.5):
+            (v, yaw_rate) = self.fuse(mounts, omega)
+            self.assertAlmostEqual(yaw_rate, omega, places=2)
+            self.assertLess(v, 0.1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+SpeedFilter of the OBD
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'base'))
+try:
+    import numpy as np
+    from OBD import SpeedFilter, WatchDog
+except ImportError: # the OBD needs zmq, pymongo and cherrypy
+    SpeedFilter = None
+
+@unittest.skipIf(SpeedFilter is None, 'OBD dependencies are not installed')
+class TestSpeedFilter(unittest.TestCase):
+
+    def test_nan_update_leaves_state_unchanged(self):
+        f = SpeedFilter()
+        f.wheel(10.0, 0.0)
+        (x, P, t) = (f.x.copy(), f.P.copy(), f.t)
+        self.assertFalse(f.vision(float('nan'), 0.1))
+        self.assertFalse(f.wheel(float('inf'), 0.1))
+        self.assertTrue(np.array_equal(f.x, x))
+        self.assertTrue(np.array_equal(f.P, P))
+        self.assertEqual(f.t, t)
+
+    def test_recovers_after_nan(self):
+        f = SpeedFilter()
+        f.vision(float('nan'), 0.0)
+        for i in range(100):
+            f.wheel(10.0, 0.01 * (i + 1))
+        (v, sigma) = f.estimate()
+        self.assertTrue(np.isfinite(v))
+        self.assertAlmostEqual(v, 10.0, delta=0.5)
+
+@unittest.skipIf(SpeedFilter is None, 'OBD dependencies are not installed')
+class TestFuseSpeed(unittest.TestCase):
+
+    def watchdog(self):
+        w = WatchDog.__new__(WatchDog) # without the ZMQ, DB and log setup
+        w.config = {'WHEEL_DIAMETER' : 0.6, 'DIFF_RATIO' : 2.0}
+        w.data = {}
+        w.speed_filter = SpeedFilter()
+        return w
+
+    def test_wheel_and_driveshaft_are_one_measurement(self):
+        rpm = 10.0 / (np.pi * 0.6 * 0.06) # 10 km/hr
+        (both, wheel) = (self.watchdog(), self.watchdog())
+        both.fuse_speed('TCS', {'wheel_rpm' : rpm, 'driveshaft_rpm' : 2.0 * rpm})
+        wheel.fuse_speed('TCS', {'wheel_rpm' : rpm})
+        self.assertEqual(both.data['v_conf'], wheel.data['v_conf'])
+        self.assertAlmostEqual(both.data['v_fused'], wheel.data['v_fused'], places=2)
+
+if __name__ == '__main__':
+    unittest.main()
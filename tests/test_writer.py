@@ -0,0 +1,41 @@
+"""
+Writer queue of the CMQ
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'base'))
+try:
+    from CMQ import Writer
+except ImportError: # the CMQ needs pyserial, zmq and pymongo
+    Writer = None
+
+class StubDevice:
+    uid = 'TCS'
+    timeout = 0.1
+
+@unittest.skipIf(Writer is None, 'CMQ dependencies are not installed')
+class TestWriter(unittest.TestCase):
+
+    def queued(self, writer):
+        return [command for (t, command, callbacks) in list(writer.safety) + list(writer.normal)]
+
+    def test_resent_command_moves_to_tail(self):
+        writer = Writer(StubDevice()) # not started, so the queue is kept
+        writer.send('F')
+        writer.send('B')
+        self.assertFalse(writer.send('F'))
+        self.assertEqual(self.queued(writer), ['B', 'F'])
+
+    def test_safety_command_fails_dropped_commands(self):
+        writer = Writer(StubDevice())
+        failed = []
+        writer.send('F', on_failure=lambda: failed.append('F'))
+        writer.send('O', safety=True)
+        self.assertEqual(self.queued(writer), ['O'])
+        self.assertEqual(failed, ['F'])
+        self.assertEqual(writer.dropped, 1)
+
+if __name__ == '__main__':
+    unittest.main()